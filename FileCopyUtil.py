@@ -12,20 +12,80 @@ hard drive unless your computer has lots of additional hard drive space. You
 should also move the excel document with the list of patient MRN's into this
 location as well. """
 
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from csv import writer as _writer
-import easygui
+import errno
+import hashlib
+import heapq
 import io
-import itertools
+import json
+import mmap
 import os
-from rarfile import RarFile
 import re
-from shutil import copytree, copyfile
+from shutil import copystat
+import sqlite3
+import struct
 import sys
+import threading
 import time
-from xlrd import open_workbook
 from zipfile import ZipFile
 
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+# easygui, rarfile and xlrd are slow to import (rarfile also looks for unrar when it is first used), so
+# they are imported by the functions that need them, and runs that do not touch them do not pay for them
+
 logname = None
+headless = False # log messages instead of showing dialogs, so that easygui/tkinter are never imported (set by cli)
+archive_cache_name = 'ArchiveCache.db' # persistent archive listing cache, written next to SearchHist.log. None to disable
+archive_cache_max_entries = 200000
+copy_journal_name = 'CopyJournal.db' # journal of completed copies, kept in the copy folder so that an interrupted copy can be resumed. None to disable
+tree_index_name = None # e.g. 'TreeIndex.db' to keep a persistent index of the searched tree, so that repeat searches only re-list changed directories
+
+_DIGIT_RUN = re.compile(r"[0-9]+")
+# volumes of multi-volume .rar sets: name.part01.rar, name.part02.rar, ... or name.rar, name.r00, name.r01, ...
+_RAR_NEW_VOLUME = re.compile(r"(.*)\.part([0-9]+)\.rar$", re.IGNORECASE)
+_RAR_OLD_VOLUME = re.compile(r"(.*)\.r([0-9]{2})$", re.IGNORECASE)
+
+# prebuilt MRN index file: magic, then counts of keys, entries, name bytes and search path bytes
+_MRN_INDEX_MAGIC = b'MRNIDX01'
+_MRN_INDEX_HEADER = struct.Struct('<8sQQQQ')
+
+# zip end of central directory records (plain and Zip64) and central directory file header, as in zipfile
+_ZIP_END = struct.Struct('<4s4H2LH')
+_ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_END = struct.Struct('<4sQ2H2L4Q')
+_ZIP_CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+_ZIP_CENTRAL_DIR_NAME = struct.Struct('<4s4xH18x3H') # signature, flags and name/extra/comment lengths only
+
+_MTIME_GRANULARITY_NS = 2 * 10**9 # coarsest directory mtime resolution to expect (FAT/exFAT, some SMB mounts)
+_FICLONE = 0x40049409 # linux ioctl to reflink a whole file
+_COPY_BUFSIZE = 1024 * 1024
+_CHECKSUM_ALGORITHMS = ('sha256', 'blake2b') # manifests are named manifest.<algorithm>, in the format of sha256sum/b2sum
+
+# for each archive that matched in the current search: the matching member names, by patient ID
+_archive_member_matches = {}
+# first volume of the multi-volume .rar set of each volume seen in the current search (None for first
+# volumes), by path, and the directories that _first_rar_volume had to list itself
+_rar_first_volumes = {}
+_rar_listed_dirs = set()
+
+# connection to the persistent archive listing cache, and changes to write back when the search ends
+_archive_cache = None
+_archive_cache_lock = threading.Lock()
+_archive_cache_hits = []
+_archive_cache_new = []
+
+# connection to the persistent tree index, and listings waiting to be written to it
+_tree_index = None
+_tree_index_lock = threading.Lock()
+_tree_index_new = []
+_tree_index_removed = []
 
 def _write_to_log(msg, print_to_screen=True):
     """Append message to a file and print to screen."""
@@ -36,6 +96,14 @@ def _write_to_log(msg, print_to_screen=True):
     if print_to_screen:
         print(msg)
 
+def _show_message(msg):
+    """Show a message box, or only log the message when running headless."""
+    if headless:
+        _write_to_log(msg)
+    else:
+        import easygui
+        easygui.msgbox(msg)
+
 def _name_has_mrn(filename):
     """Returns whether a filename contains some MRN (has exactly 7 digits in a row).
     False negatives are ok, but false positives are not, so the criteria for a match should be tight."""
@@ -48,42 +116,339 @@ def _mrn_in_name(mrn, filename):
     else:
         return re.search("^(.*[^0-9])?0*" + mrn + "([^0-9].*)?$", filename) is not None
 
-def _check_zip(mrn, zip_file):
-    """Check if any zip file members contain a target string in their filename."""
+def _mrn_key(patient_id):
+    """Returns a patient ID as an integer MRN, or None if it is not purely numeric (e.g. an accession number).
+    Leading zeros and surrounding whitespace are ignored, and whole floats (as read from excel) are accepted."""
+    if isinstance(patient_id, float) and patient_id.is_integer():
+        return int(patient_id)
+    if isinstance(patient_id, int):
+        return patient_id
+    patient_id = str(patient_id).strip()
+    if re.match(r"^[0-9]+$", patient_id) is None:
+        return None
+    return int(patient_id)
+
+def _build_mrn_index(patient_ids):
+    """Index a list of patient IDs for single-pass matching.
+    Returns a dict mapping each integer MRN to the patient IDs that share it, and a list of
+    non-numeric patient IDs that have to be matched one by one with _mrn_in_name."""
+    mrn_index = {}
+    other_ids = []
+    for patient_id in patient_ids:
+        key = _mrn_key(patient_id)
+        if key is None:
+            if patient_id not in other_ids:
+                other_ids.append(patient_id)
+        elif patient_id not in mrn_index.setdefault(key, []):
+            mrn_index[key].append(patient_id)
+
+    return mrn_index, other_ids
+
+def _mrns_in_name(filename, mrn_index, other_ids=()):
+    """Returns all patient IDs whose MRN is contained within a filename, with the same semantics as _mrn_in_name.
+    Each run of digits in the name is looked up once in mrn_index (see _build_mrn_index)."""
+    matches = []
+    for key in set(int(digits) for digits in _DIGIT_RUN.findall(filename)):
+        matches.extend(mrn_index.get(key, ()))
+
+    for patient_id in other_ids:
+        if _mrn_in_name(str(patient_id).strip(), filename):
+            matches.append(patient_id)
+
+    return matches
+
+def _list_archive(archive_file):
+    """Return the member names of a .zip/.rar file, or None if it cannot be opened.
+    Listings are not kept in memory, since the search visits each archive once, and the members that
+    matched are recorded by _check_archive; the persistent archive cache avoids re-reading them between runs."""
     try:
-        zip_members = ZipFile(zip_file).namelist()
-    except Exception as e:
-        _write_to_log("Error opening zip file %s: %s, %s" % (zip_file, str(sys.exc_info()[0]), str(e)), print_to_screen=False)
-        return False
+        st = os.stat(archive_file)
+    except OSError:
+        st = None
 
-    for filename in zip_members:
-        if _mrn_in_name(mrn, filename):
-            return True
+    members = _get_cached_listing(archive_file, st)
+    if members is None:
+        try:
+            if archive_file.endswith('.zip'):
+                members = _read_zip_names(archive_file)
+                if members is None:
+                    with ZipFile(archive_file) as archive:
+                        members = archive.namelist()
+            else:
+                from rarfile import rar_namelist
+                members = rar_namelist(archive_file)
+            _set_cached_listing(archive_file, st, members)
+        except Exception as e:
+            _write_to_log("Error opening %s file %s: %s, %s" % (archive_file[-3:], archive_file, str(sys.exc_info()[0]), str(e)), print_to_screen=False)
 
-    return False
+    return members
+
+def _read_zip_names(zip_file):
+    """Return the member names of a zip file, the same as ZipFile.namelist(), by reading them straight
+    out of the central directory, without creating a ZipInfo per member.
+    Returns None for anything unusual (split archives, bad signatures, Info-ZIP unicode path fields, ...),
+    for ZipFile to handle."""
+    with open(zip_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        tail_size = min(size, _ZIP_END.size + 0xFFFF)
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+        end_pos = tail.rfind(b'PK\x05\x06')
+        if end_pos < 0 or end_pos + _ZIP_END.size > len(tail):
+            return None
+        _, disk, cd_disk, _, entries, cd_size, cd_offset, _ = _ZIP_END.unpack_from(tail, end_pos)
+        end_pos += size - tail_size
+
+        if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+            locator_pos = end_pos - _ZIP64_END_LOCATOR.size
+            if locator_pos < _ZIP64_END.size:
+                return None
+            f.seek(locator_pos)
+            sig, _, end64_offset, disks = _ZIP64_END_LOCATOR.unpack(f.read(_ZIP64_END_LOCATOR.size))
+            if sig != b'PK\x06\x07' or disks > 1:
+                return None
+            # like zipfile, the Zip64 record is expected right before its locator
+            end_pos = locator_pos - _ZIP64_END.size
+            f.seek(end_pos)
+            sig, _, _, _, disk, cd_disk, _, entries, cd_size, cd_offset = _ZIP64_END.unpack(f.read(_ZIP64_END.size))
+            if sig != b'PK\x06\x06':
+                return None
+
+        # data prepended to the archive (e.g. a self-extractor) shifts all offsets
+        cd_start = end_pos - cd_size
+        if disk != 0 or cd_disk != 0 or cd_start < 0 or cd_start < cd_offset:
+            return None
+        if cd_size == 0:
+            return [] if entries == 0 else None
+
+        names = []
+        unpack_header = _ZIP_CENTRAL_DIR_NAME.unpack_from
+        header_size = _ZIP_CENTRAL_DIR.size
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            cd = memoryview(mm)
+            try:
+                pos = cd_start
+                while pos < end_pos:
+                    if pos + header_size > end_pos:
+                        return None
+                    sig, flags, name_len, extra_len, comment_len = unpack_header(cd, pos)
+                    if sig != b'PK\x01\x02' or pos + header_size + name_len + extra_len + comment_len > end_pos:
+                        return None
+                    pos += header_size
+                    name = str(cd[pos:pos + name_len], 'utf-8' if flags & 0x800 else 'cp437')
+                    pos += name_len
+
+                    extra_end = pos + extra_len
+                    while pos + 4 <= extra_end:
+                        tag, length = struct.unpack_from('<HH', cd, pos)
+                        if tag == 0x7075:
+                            return None
+                        pos += 4 + length
+                    pos = extra_end + comment_len
+
+                    if '\0' in name:
+                        name = name[:name.find('\0')]
+                    names.append(name)
+            finally:
+                cd.release()
+
+        if len(names) != entries:
+            return None
+    if os.sep != '/':
+        names = [name.replace(os.sep, '/') for name in names]
+    return names
+
+def compare_zip_listing(zip_file, repeat=3):
+    """Time listing a zip with _read_zip_names against ZipFile.namelist(), check that both give the
+    same names, and report the time and peak Python memory of each. Returns the speedup."""
+    import tracemalloc
+
+    def measure(list_names):
+        best = None
+        for _ in range(repeat):
+            t1 = time.perf_counter()
+            names = list_names()
+            elapsed = time.perf_counter() - t1
+            best = elapsed if best is None else min(best, elapsed)
+        tracemalloc.start()
+        list_names()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return names, best, peak
+
+    def zipfile_names():
+        with ZipFile(zip_file) as archive:
+            return archive.namelist()
+
+    fast_names, fast_time, fast_peak = measure(lambda: _read_zip_names(zip_file))
+    zip_names, zip_time, zip_peak = measure(zipfile_names)
+    if fast_names is None:
+        _write_to_log("%s is handled by the ZipFile fallback." % zip_file)
+    elif fast_names != zip_names:
+        _write_to_log("Warning: central directory reader and ZipFile listed different names for %s." % zip_file)
+
+    speedup = zip_time / max(fast_time, 1e-9)
+    _write_to_log("%s, %d members. ZipFile: %.4f s, peak %.1f MB. Central directory reader: %.4f s, peak %.1f MB. Speedup: %.2fx"
+                  % (zip_file, len(zip_names), zip_time, zip_peak / 1e6, fast_time, fast_peak / 1e6, speedup))
+    return speedup
+
+def _open_archive_cache():
+    """Open the persistent archive listing cache (archive_cache_name), creating it if needed."""
+    global _archive_cache
+    del _archive_cache_hits[:]
+    del _archive_cache_new[:]
+    if archive_cache_name is None:
+        return
 
-def _check_rar(mrn, rar_file):
-    """Check if any rar file members contain a target string in their filename."""
     try:
-        rar_members = RarFile(rar_file).namelist()
-    except Exception as e:
-        _write_to_log("Error opening rar file %s: %s, %s" % (rar_file, str(sys.exc_info()[0]), str(e)), print_to_screen=False)
-        return False
+        _archive_cache = sqlite3.connect(archive_cache_name, check_same_thread=False)
+        # paths are stored as os.fsencode() bytes, since names that are not valid UTF-8 cannot be stored as TEXT
+        _archive_cache.execute("CREATE TABLE IF NOT EXISTS archives (path BLOB PRIMARY KEY, size INTEGER, "
+                            "mtime INTEGER, inode INTEGER, members TEXT, last_used REAL)")
+    except sqlite3.Error as e:
+        _write_to_log("Could not open archive cache %s: %s" % (archive_cache_name, str(e)), print_to_screen=False)
+        _archive_cache = None
 
-    for filename in rar_members:
-        if _mrn_in_name(mrn, filename):
-            return True
+def _close_archive_cache(search_path, search_start):
+    """Write back cache changes from this search, evict entries under search_path whose archive
+    has disappeared, trim the cache to archive_cache_max_entries and close it."""
+    global _archive_cache
+    if _archive_cache is None:
+        return
+
+    try:
+        with _archive_cache:
+            _archive_cache.executemany("UPDATE archives SET last_used = ? WHERE path = ?", _archive_cache_hits)
+            _archive_cache.executemany("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?)", _archive_cache_new)
+
+            prefix = os.fsencode(os.path.join(os.path.abspath(search_path), ''))
+            unused = _archive_cache.execute("SELECT path FROM archives WHERE last_used < ? AND substr(path, 1, ?) = ?",
+                                        (search_start, len(prefix), prefix)).fetchall()
+            _archive_cache.executemany("DELETE FROM archives WHERE path = ?", [row for row in unused if not os.path.exists(row[0])])
+
+            _archive_cache.execute("DELETE FROM archives WHERE path IN (SELECT path FROM archives ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                                (archive_cache_max_entries,))
+    except sqlite3.Error as e:
+        _write_to_log("Could not update archive cache %s: %s" % (archive_cache_name, str(e)), print_to_screen=False)
+
+    _archive_cache.close()
+    _archive_cache = None
+
+def _get_cached_listing(archive_file, st):
+    """Return an archive's member names from the persistent cache, or None if it is not cached or has changed."""
+    if _archive_cache is None or st is None:
+        return None
+
+    path = os.fsencode(os.path.abspath(archive_file))
+    with _archive_cache_lock:
+        row = _archive_cache.execute("SELECT size, mtime, inode, members FROM archives WHERE path = ?", (path,)).fetchone()
+    if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime_ns, st.st_ino):
+        return None
+
+    _archive_cache_hits.append((time.time(), path))
+    return json.loads(row[3])
 
-    return False
+def _set_cached_listing(archive_file, st, members):
+    """Queue an archive's member names to be stored in the persistent cache."""
+    if _archive_cache is not None and st is not None:
+        _archive_cache_new.append((os.fsencode(os.path.abspath(archive_file)), st.st_size, st.st_mtime_ns, st.st_ino, json.dumps(members), time.time()))
+
+def _check_archive(archive_file, mrn_index, other_ids=()):
+    """Returns all patient IDs that are contained in the filename of some member of a .zip/.rar file.
+    The matching members are recorded for _matching_members."""
+    members_by_id = {}
+    for filename in _list_archive(archive_file) or []:
+        for patient_id in _mrns_in_name(filename, mrn_index, other_ids):
+            members_by_id.setdefault(patient_id, []).append(filename)
+
+    if members_by_id:
+        _archive_member_matches[archive_file] = members_by_id
+    return list(members_by_id)
+
+def _rar_volume_sets(name_list):
+    """Group the multi-volume .rar sets among the files of one directory.
+    Returns a dict of first volume -> all volumes of the set, in order."""
+    names = set(name_list)
+    volumes_by_set = {}
+    for filename in name_list:
+        m = _RAR_NEW_VOLUME.match(filename)
+        if m:
+            volumes_by_set.setdefault((m.group(1), len(m.group(2))), []).append((int(m.group(2)), filename))
+            continue
+        m = _RAR_OLD_VOLUME.match(filename)
+        if m:
+            for first in (m.group(1) + '.rar', m.group(1) + '.RAR'):
+                if first in names:
+                    volumes_by_set.setdefault(first, [(-1, first)]).append((int(m.group(2)), filename))
+                    break
+
+    volume_sets = {}
+    for volumes in volumes_by_set.values():
+        if len(volumes) > 1:
+            volumes = [filename for _, filename in sorted(volumes)]
+            volume_sets[volumes[0]] = volumes
+    return volume_sets
+
+def _record_rar_volumes(root, volume_sets):
+    """Remember the first volume of each volume of the .rar sets (from _rar_volume_sets) of directory root."""
+    for first, volumes in volume_sets.items():
+        _rar_first_volumes[root + '/' + first] = None
+        for volume in volumes[1:]:
+            _rar_first_volumes[root + '/' + volume] = root + '/' + first
+
+def _first_rar_volume(path):
+    """Return the first volume of the multi-volume .rar set that path is a later volume of, or None.
+    Sets that the current search came across are known already; otherwise the directory is listed, once."""
+    if path in _rar_first_volumes:
+        return _rar_first_volumes[path]
+    dirname, filename = os.path.split(path)
+    if not (_RAR_NEW_VOLUME.match(filename) or _RAR_OLD_VOLUME.match(filename)) or dirname in _rar_listed_dirs:
+        return None
+
+    _rar_listed_dirs.add(dirname)
+    try:
+        listing = os.listdir(dirname or '.')
+    except OSError:
+        return None
+    volume_sets = _rar_volume_sets(listing)
+    _record_rar_volumes(dirname, volume_sets)
+    for first, volumes in volume_sets.items():
+        if filename in volumes[1:]:
+            return dirname + '/' + first
+    return None
+
+def _is_archive(filename):
+    return filename.endswith('.zip') or filename.endswith('.rar') or _RAR_OLD_VOLUME.match(filename) is not None
+
+def _matching_members(archive_file, patient_id):
+    """Return the members of a .zip/.rar file whose names contain patient_id, as recorded by the
+    search, or by listing the archive again if it was not matched in this session."""
+    if archive_file in _archive_member_matches:
+        return _archive_member_matches[archive_file].get(patient_id, [])
+
+    mrn_index = _build_mrn_index([patient_id])
+    return [member for member in _list_archive(archive_file) or [] if _mrns_in_name(member, *mrn_index)]
+
+def _check_zip(mrn, zip_file):
+    """Check if any zip file members contain a target string in their filename."""
+    return len(_check_archive(zip_file, *_build_mrn_index([mrn]))) > 0
+
+def _check_rar(mrn, rar_file):
+    """Check if any rar file members contain a target string in their filename."""
+    return len(_check_archive(rar_file, *_build_mrn_index([mrn]))) > 0
 
 def _has_different_mrn(subdir, patient_ids):
     """Returns True if subdir's name has an MRN that does not match one of the MRNs in patient_ids.
-    patient_ids should be a list of ints."""
-    try: 
-        i = subdir
-        return i not in patient_ids
-    except ValueError:
-        return _name_has_mrn(subdir)
+    patient_ids should be a list of ints (or an MRN index from _build_mrn_index).
+    Names without an MRN, such as years or series numbers, never count as a different MRN."""
+    if not _name_has_mrn(subdir):
+        return False
+
+    return not any(int(digits) in patient_ids for digits in _DIGIT_RUN.findall(subdir))
+
+def _is_excluded(subdir, exc_dirs):
+    """Returns True if subdir's name contains one of the folder names the user asked to exclude."""
+    return any(exc_dir in subdir for exc_dir in exc_dirs)
 
 def _make_dir(new_dir):
     try:
@@ -93,6 +458,40 @@ def _make_dir(new_dir):
     except:
         print("Unexpected error in mkdir for %s: %s" % (new_dir, str(sys.exc_info()[0])))
 
+def find_numbers_in_filenames(patient_ids, name_list, root=None, mrn_index=None):
+    """Return the members of a list of strings that contain each patient ID, as a dict
+    of patient ID -> matching names. Each name is only tokenized once, however many
+    patient IDs there are.
+
+    name_list: list of filenames and dir names to compare patient_ids against
+    mrn_index: optional index of patient_ids from _build_mrn_index, to avoid rebuilding it
+
+    Uses the same rules as find_number_in_filename. A multi-volume .rar set is only opened from its
+    first volume, and if its members match, all of its volumes match."""
+    if mrn_index is None:
+        mrn_index = _build_mrn_index(patient_ids)
+    matches = dict((patient_id, []) for patient_id in patient_ids)
+    volume_sets = _rar_volume_sets(name_list)
+    if volume_sets and root is not None:
+        _record_rar_volumes(root, volume_sets)
+    first_volumes = dict((volume, first) for first, volumes in volume_sets.items() for volume in volumes)
+    archive_matches = {}
+
+    for filename in name_list:
+        matching_ids = _mrns_in_name(filename, *mrn_index)
+        for patient_id in matching_ids:
+            matches[patient_id].append(filename)
+
+        archive = first_volumes.get(filename, filename)
+        if archive.endswith('.zip') or archive.endswith('.rar'):
+            if archive not in archive_matches:
+                archive_matches[archive] = _check_archive(root+'/'+archive, *mrn_index)
+            for patient_id in archive_matches[archive]:
+                if patient_id not in matching_ids:
+                    matches[patient_id].append(filename)
+
+    return matches
+
 def find_number_in_filename(mrn, name_list, root=None):
     """Return all members of a list of strings that contain a target MRN.
 
@@ -103,20 +502,13 @@ def find_number_in_filename(mrn, name_list, root=None):
     but exclude 'mri1550' and '5500.txt'.
     .zip/.rar files in name_list will also be included if one of its members
     is considered a match."""
-    matches = []
-    for filename in name_list:
-        if _mrn_in_name(mrn, filename):
-            matches.append(filename)
-        elif filename.endswith('.zip') and _check_zip(mrn, root+'/'+filename):
-            matches.append(filename)
-        elif filename.endswith('.rar') and _check_rar(mrn, root+'/'+filename):
-            matches.append(filename)
-
-    return matches
+    return find_numbers_in_filenames([mrn], name_list, root)[mrn]
 
 def setup_ui(skip_col=False, skip_exc=True):
     """UI flow. Returns None if cancelled or terminated with error, else returns
     patient_ids, search_path and directories to exclude."""
+    import easygui
+
     if not easygui.msgbox(('This utility searches a directory to retrieve subfolders and filenames that contain MRNs or accession numbers. '
                         'It will copy these files/folders to separate folders for each number. MRNs can be entered manually, or uploaded in .xlsx or .xls format.\n'
                         'NOTE: This program will search inside .zip/.rar files as well. If there is a match, it will copy the entire file. Other compressed formats not supported.')):
@@ -142,17 +534,8 @@ def setup_ui(skip_col=False, skip_exc=True):
                 return None
 
         # Get list of MRNs to search
-        ws = open_workbook(mrn_src).sheet_by_index(0)
-
-        header_offset = 0
-        try:
-            int(ws.cell(0, col).value)
-        except ValueError:
-            header_offset = 1
-
-        try:
-            patient_ids = [ws.cell(i, col).value for i in range(header_offset, ws.nrows)]
-        except ValueError:
+        patient_ids = _read_mrn_sheet(mrn_src, col)
+        if patient_ids is None:
             easygui.msgbox("Parsing error. May be due to wrong column selected or non-numeric entry present. This program will now exit.")
             return None
 
@@ -176,11 +559,291 @@ def setup_ui(skip_col=False, skip_exc=True):
 
     return [patient_ids, search_path, exc_dirs]
 
-def get_matching_paths(patient_ids, search_path, exc_dirs, log_freq=50):
-    """Get matching files and directories for each MRN."""
+def _read_mrn_sheet(mrn_src, col=0):
+    """Read MRNs/accession numbers from one column of an excel sheet. A header row is skipped.
+    Returns None if the column cannot be read."""
+    from xlrd import open_workbook
+    ws = open_workbook(mrn_src).sheet_by_index(0)
+
+    header_offset = 0
+    try:
+        int(ws.cell(0, col).value)
+    except ValueError:
+        header_offset = 1
+
+    try:
+        return [ws.cell(i, col).value for i in range(header_offset, ws.nrows)]
+    except (ValueError, IndexError):
+        return None
+
+def _read_mrn_list(mrn_src, col=0):
+    """Read MRNs/accession numbers from an excel sheet (see _read_mrn_sheet), or from a text file with
+    one or more per line, separated by commas."""
+    if mrn_src.endswith('.xlsx') or mrn_src.endswith('.xls'):
+        return _read_mrn_sheet(mrn_src, col)
+
+    with io.open(mrn_src, encoding='utf8') as f:
+        return [patient_id.strip() for line in f for patient_id in line.split(',') if patient_id.strip()]
+
+def _search_dir(root, subdirs, files, patient_ids, exc_dirs, mrn_index, exc_paths=()):
+    """Match the entries of one directory against the MRN index. Like in os.walk, subdirs is pruned
+    in place to the folders that still need to be searched. Folders whose absolute path is in exc_paths
+    (such as the copy folder) are not searched either.
+    Returns matching folders and files by patient ID (as full paths), and the excluded folders."""
+    skipped_dirs = []
+
+    # exclude directories specified by user
+    subdirs[:] = [d for d in subdirs if not _is_excluded(d, exc_dirs)]
+    if exc_paths:
+        temp_exdirs = [d for d in subdirs if os.path.abspath(os.path.join(root, d)) in exc_paths]
+        skipped_dirs.extend(root + '/' + d for d in temp_exdirs)
+        subdirs[:] = [d for d in subdirs if d not in temp_exdirs]
+
+    # exclude directories with an MRN that is not one of the target MRNs, unless the name matches one of the
+    # searched IDs in another way (e.g. a folder named after an accession number)
+    temp_exdirs = []
+    for subdir in subdirs:
+        if _has_different_mrn(subdir, mrn_index[0]) and not _mrns_in_name(subdir, *mrn_index):
+            skipped_dirs.append(root + '/' + subdir)
+            temp_exdirs.append(subdir)
+            _write_to_log("Excluding folder %s because it's suspected to contain an irrelevant MRN" % subdir, print_to_screen=False)
+
+    subdirs[:] = [d for d in subdirs if d not in temp_exdirs]
+
+    matching_dirs = find_numbers_in_filenames(patient_ids, subdirs, root, mrn_index)
+    matching_files = find_numbers_in_filenames(patient_ids, files, root, mrn_index)
+
+    # matching directories are copied whole, so there is no need to search them
+    temp_exdirs = [d for patient_id in matching_dirs for d in matching_dirs[patient_id]]
+    subdirs[:] = [d for d in subdirs if d not in temp_exdirs]
+
+    for matches in (matching_dirs, matching_files):
+        for patient_id in matches:
+            matches[patient_id] = [root + '/' + name for name in matches[patient_id]]
+
+    return matching_dirs, matching_files, skipped_dirs
+
+def _list_dir(root):
+    """List a directory with os.scandir the way os.walk does. Returns (subdirs, files), or None if it cannot be read.
+    If the tree index is open, directories whose mtime has not changed since they were indexed are not re-listed.
+    A directory whose mtime is within _MTIME_GRANULARITY_NS of the listing may still change without a new mtime,
+    so it is indexed without an mtime, and listed again by the next search."""
+    indexed = None
+    if _tree_index is not None:
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            return None
+
+        indexed = _get_indexed_listing(root)
+        if indexed is not None and indexed[0] == mtime:
+            return indexed[1], indexed[2]
+        listed_at = time.time_ns()
+
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.name)
+                elif _tree_index is None:
+                    files.append(entry.name)
+                else:
+                    try:
+                        st = entry.stat()
+                        files.append((entry.name, st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        files.append((entry.name, None, None))
+    except OSError:
+        return None
+
+    if _tree_index is not None:
+        # subdirectories that disappeared since the last scan are dropped from the index along with their contents
+        removed = [] if indexed is None else [d for d in indexed[1] if d not in subdirs]
+        _set_indexed_listing(root, mtime if mtime < listed_at - _MTIME_GRANULARITY_NS else None, subdirs, files, removed)
+        files = [f[0] for f in files]
+
+    return subdirs, files
+
+def _walk(search_path, visit):
+    """Walk a directory tree like os.walk, using _list_dir so that the tree index is used if it is open.
+    visit(root, subdirs, files) may prune subdirs in place. Yields (root, subdirs, files, visit result)."""
+    stack = [search_path]
+    while stack:
+        root = stack.pop()
+        listing = _list_dir(root)
+        if listing is None:
+            continue
+
+        subdirs, files = listing
+        yield root, subdirs, files, visit(root, subdirs, files)
+        for subdir in reversed(subdirs):
+            path = os.path.join(root, subdir)
+            if not os.path.islink(path):
+                stack.append(path)
+
+def _open_tree_index():
+    """Open the persistent tree index (tree_index_name), creating it if needed."""
+    global _tree_index
+    del _tree_index_new[:]
+    del _tree_index_removed[:]
+    if tree_index_name is None:
+        return
+
+    try:
+        _tree_index = sqlite3.connect(tree_index_name, check_same_thread=False)
+        # paths are stored as os.fsencode() bytes, like in the archive cache
+        _tree_index.execute("CREATE TABLE IF NOT EXISTS dirs (path BLOB PRIMARY KEY, mtime INTEGER, subdirs TEXT, files TEXT)")
+    except sqlite3.Error as e:
+        _write_to_log("Could not open tree index %s: %s" % (tree_index_name, str(e)), print_to_screen=False)
+        _tree_index = None
+
+def _flush_tree_index():
+    """Write pending directory listings to the tree index."""
+    with _tree_index_lock:
+        new_rows = _tree_index_new[:]
+        removed = _tree_index_removed[:]
+        del _tree_index_new[:]
+        del _tree_index_removed[:]
+        try:
+            with _tree_index:
+                # directories that disappeared since they were indexed, along with everything below them
+                for path in removed:
+                    _tree_index.execute("DELETE FROM dirs WHERE path = ? OR (path > ? AND path < ?)",
+                                        (path, path + os.fsencode(os.sep), path + bytes([ord(os.sep) + 1])))
+                _tree_index.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", new_rows)
+        except sqlite3.Error as e:
+            _write_to_log("Could not update tree index %s: %s" % (tree_index_name, str(e)), print_to_screen=False)
+
+def _close_tree_index():
+    """Write back pending listings and close the tree index."""
+    global _tree_index
+    if _tree_index is None:
+        return
+
+    _flush_tree_index()
+    _tree_index.close()
+    _tree_index = None
+
+def _get_indexed_listing(root):
+    """Return (mtime, subdirs, files) for a directory from the tree index, or None if it is not indexed."""
+    if _tree_index is None:
+        return None
+
+    with _tree_index_lock:
+        row = _tree_index.execute("SELECT mtime, subdirs, files FROM dirs WHERE path = ?", (os.fsencode(os.path.abspath(root)),)).fetchone()
+    if row is None:
+        return None
+
+    return row[0], json.loads(row[1]), [f[0] for f in json.loads(row[2])]
+
+def _set_indexed_listing(root, mtime, subdirs, files, removed_subdirs=()):
+    """Queue a directory listing (files as (name, size, mtime) tuples) to be stored in the tree index."""
+    root = os.path.abspath(root)
+    with _tree_index_lock:
+        _tree_index_new.append((os.fsencode(root), mtime, json.dumps(subdirs), json.dumps(files)))
+        _tree_index_removed.extend(os.fsencode(os.path.join(root, d)) for d in removed_subdirs)
+        flush = len(_tree_index_new) >= 1000
+    if flush:
+        _flush_tree_index()
+
+def _walk_parallel(search_path, visit, workers, max_pending=None):
+    """Walk a directory tree like os.walk, but list directories concurrently on a pool of threads.
+
+    visit(root, subdirs, files) is called on the worker thread right after a directory is listed,
+    and may prune subdirs in place; only the remaining subdirs are queued for listing.
+    Yields (root, subdirs, files, visit result) in the same order as os.walk, as soon as each
+    directory (and all the ones before it) has been visited.
+    At most max_pending (default: 32 per worker) directories are being listed or wait to be yielded.
+    Each one that is yielded frees a slot for the next queued directory in walk order, so a consumer
+    that stops pulling results also stops the walk."""
+    if max_pending is None:
+        max_pending = 32 * workers
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    lock = threading.Lock()
+    # directories to list as [walk order, path, future], in a heap by walk order. The future is None
+    # until the directory gets a slot, and False if the consumer listed it itself
+    queued = []
+    free_slots = [max_pending]
+
+    def queue(order, path):
+        entry = [order, path, None]
+        heapq.heappush(queued, entry)
+        return entry
+
+    def start_queued():
+        """Start listing the queued directories that come first in walk order, while there are free slots.
+        Called with lock held."""
+        while free_slots[0] and queued and not stop.is_set():
+            entry = heapq.heappop(queued)
+            if entry[2] is None:
+                entry[2] = pool.submit(list_and_visit, entry)
+                free_slots[0] -= 1
+
+    def list_and_visit(entry):
+        order, root = entry[:2]
+        if stop.is_set():
+            return None
+        listing = _list_dir(root)
+        if listing is None:
+            return None
+
+        subdirs, files = listing
+        result = visit(root, subdirs, files)
+        paths = [os.path.join(root, subdir) for subdir in subdirs]
+        paths = [(i, path) for i, path in enumerate(paths) if not os.path.islink(path)]
+        with lock:
+            children = [queue(order + (i,), path) for i, path in paths]
+            start_queued()
+
+        return root, subdirs, files, result, children
+
+    try:
+        with lock:
+            pending = [queue((), search_path)]
+            start_queued()
+        while pending:
+            entry = pending.pop()
+            with lock:
+                future = entry[2]
+                if future is None:
+                    entry[2] = False
+            if future is None:
+                # no slot came free for it yet
+                ret = list_and_visit(entry)
+            else:
+                ret = future.result()
+                with lock:
+                    free_slots[0] += 1
+                    start_queued()
+            if ret is None:
+                continue
+            root, subdirs, files, result, children = ret
+            yield root, subdirs, files, result
+            pending.extend(reversed(children))
+    finally:
+        with lock:
+            stop.set()
+        pool.shutdown(wait=True)
+
+def iter_matching_paths(patient_ids, search_path, exc_dirs, log_freq=50, workers=1, append_history=False, exc_paths=()):
+    """Search like get_matching_paths, but yield each (patient_id, path) match as soon as it is found.
+    Matches come in the same order as get_matching_paths lists them."""
     t1 = time.time()
-    # dict to store matching paths
-    paths_by_patient_id = dict((patient_id, []) for patient_id in patient_ids)
+    exc_paths = set(os.path.abspath(path) for path in exc_paths)
+    mrn_index = _build_mrn_index(patient_ids)
+    unique_ids = [patient_id for patient_id in dict((patient_id, None) for patient_id in patient_ids)]
+    _archive_member_matches.clear()
+    _rar_first_volumes.clear()
+    _rar_listed_dirs.clear()
+    _open_archive_cache()
+    _open_tree_index()
 
     # to track progress
     match_dir_cnt = 0
@@ -189,53 +852,42 @@ def get_matching_paths(patient_ids, search_path, exc_dirs, log_freq=50):
     searched_dirs = []
     skipped_dirs = []
 
-    #search for matching folders/files
-    for root, subdirs, files in os.walk(search_path):
-        searched_dirs.append(root)
-
-        # exclude directories specified by user
-        for exc_dir, subdir in itertools.product(exc_dirs, subdirs):
-            if exc_dir in subdir:
-                exc_dirs.append(root + '/' + exc_dir)
-                subdirs.remove(subdir)
-                break
+    def visit(root, subdirs, files):
+        return _search_dir(root, subdirs, files, patient_ids, exc_dirs, mrn_index, exc_paths)
 
-        # exclude directories with an MRN that is not one of the target MRNs
-        temp_exdirs = []
-        for subdir in subdirs:
-            if _has_different_mrn(subdir, patient_ids):
-                skipped_dirs.append(root + '/' + subdir)
-                temp_exdirs.append(subdir)
-                _write_to_log("Excluding folder %s because it's suspected to contain an irrelevant MRN" % subdir, print_to_screen=False)
-
-        subdirs[:] = [d for d in subdirs if d not in temp_exdirs]
-
-        temp_exdirs = []
-        for patient_id in patient_ids:
-            matching_dirs = find_number_in_filename(patient_id, subdirs)
-            matching_files = find_number_in_filename(patient_id, files, root)
+    if workers > 1:
+        walk = _walk_parallel(search_path, visit, workers)
+    else:
+        walk = _walk(search_path, visit)
 
-            for matching_dir in matching_dirs:
-                paths_by_patient_id[patient_id].append(root + '/' + matching_dir)
-                temp_exdirs.append(matching_dir)
-                match_dir_cnt += 1
+    #search for matching folders/files
+    try:
+        for root, subdirs, files, (matching_dirs, matching_files, skipped) in walk:
+            searched_dirs.append(root)
+            skipped_dirs.extend(skipped)
 
-            for matching_file in matching_files:
-                paths_by_patient_id[patient_id].append(root + '/' + matching_file)
-                match_file_cnt += 1
+            for patient_id in unique_ids:
+                for path in matching_dirs[patient_id] + matching_files[patient_id]:
+                    yield patient_id, path
+                match_dir_cnt += len(matching_dirs[patient_id])
+                match_file_cnt += len(matching_files[patient_id])
 
-        subdirs[:] = [d for d in subdirs if d not in temp_exdirs]
-        
-        dir_cnt += 1
-        if dir_cnt % log_freq == 1:
-            _write_to_log(("%d directories explored, %d matching files found, and %d matching folders found. "
-                        "(Last directory explored: %s at %s)") % (dir_cnt, match_file_cnt, match_dir_cnt, root, time.strftime("%X")))
+            dir_cnt += 1
+            if dir_cnt % log_freq == 1:
+                _write_to_log(("%d directories explored, %d matching files found, and %d matching folders found. "
+                            "(Last directory explored: %s at %s)") % (dir_cnt, match_file_cnt, match_dir_cnt, root, time.strftime("%X")))
+    finally:
+        walk.close()
+        _close_archive_cache(search_path, t1)
+        _close_tree_index()
 
     _write_to_log(("Search complete. %d directories explored, %d matching files found, and %d matching folders found. "
             "Time it took to run: %.4f s.\n") % (dir_cnt, match_file_cnt, match_dir_cnt, time.time() - t1))
 
     try:
-        with io.open('SearchHist.log', 'w', encoding='utf8') as f:
+        with io.open('SearchHist.log', 'a' if append_history else 'w', encoding='utf8', errors='surrogateescape') as f:
+            if append_history:
+                f.write('\n\n')
             f.write('The following directories were searched for the run at %s:\n' % time.strftime("%x, %X"))
             f.write('\n'.join(searched_dirs))
             f.write('\n\nThe following directories were excluded:\n')
@@ -244,6 +896,187 @@ def get_matching_paths(patient_ids, search_path, exc_dirs, log_freq=50):
     except:
         print("Unexpected error while writing search history: " % str(sys.exc_info()[0]))
 
+def get_matching_paths(patient_ids, search_path, exc_dirs, log_freq=50, workers=1, append_history=False, exc_paths=()):
+    """Get matching files and directories for each MRN.
+    With workers > 1, directories are listed concurrently on that many threads, which helps on
+    network shares where each listing is a round trip. Results are the same either way.
+    Folders in exc_paths (e.g. the copy folder, when it is inside search_path) are skipped.
+    The searched and excluded directories are written to SearchHist.log, or added to it with append_history."""
+    # dict to store matching paths
+    paths_by_patient_id = dict((patient_id, []) for patient_id in patient_ids)
+    for patient_id, path in iter_matching_paths(patient_ids, search_path, exc_dirs, log_freq, workers, append_history, exc_paths):
+        paths_by_patient_id[patient_id].append(path)
+
+    return paths_by_patient_id
+
+def compare_walkers(patient_ids, search_path, exc_dirs, workers=8):
+    """Run the same search with the serial walker and with the parallel walker, check that both find
+    the same paths, and report the speedup. Returns the speedup.
+    The persistent archive cache is disabled for both runs so that neither one benefits from the other."""
+    global archive_cache_name
+    cache_name, archive_cache_name = archive_cache_name, None
+    try:
+        t1 = time.time()
+        serial_paths = get_matching_paths(patient_ids, search_path, list(exc_dirs), workers=1)
+        t2 = time.time()
+        parallel_paths = get_matching_paths(patient_ids, search_path, list(exc_dirs), workers=workers)
+        t3 = time.time()
+    finally:
+        archive_cache_name = cache_name
+
+    if serial_paths != parallel_paths:
+        _write_to_log("Warning: serial and parallel searches found different paths.")
+    speedup = (t2 - t1) / max(t3 - t2, 1e-9)
+    _write_to_log("Serial walk: %.4f s, parallel walk with %d workers: %.4f s, speedup: %.2fx"
+                  % (t2 - t1, workers, t3 - t2, speedup))
+    return speedup
+
+def build_mrn_index(search_path, index_name='MRNIndex.idx'):
+    """Walk search_path once and write an inverted index of every MRN-like number in it to index_name,
+    so that query_mrn_index can answer searches without walking the tree.
+
+    Every file and folder is recorded with its parent, and every run of digits in its name (and, for
+    .zip/.rar files, in the names of its members) is indexed, using the same rules as _mrns_in_name.
+    The file holds sorted arrays that query_mrn_index memory-maps:
+    MRNs (uint64), offsets of each MRN's entries, entry IDs (uint32, in walk order), the parent of
+    each entry (int32), an is-folder flag per entry, and offsets into the entry names."""
+    t1 = time.time()
+    postings = {}
+    parents = array('i', [-1])
+    is_dir = array('B', [1])
+    name_offsets = array('Q', [0, 0])
+    names = bytearray()
+    dir_ids = {search_path: 0}
+
+    def add_entry(parent_id, name, directory, keys):
+        entry_id = len(parents)
+        parents.append(parent_id)
+        is_dir.append(directory)
+        names.extend(name.encode('utf8', 'surrogateescape'))
+        name_offsets.append(len(names))
+        for key in keys:
+            if key < 1 << 64:
+                postings.setdefault(key, array('I')).append(entry_id)
+        return entry_id
+
+    def visit(root, subdirs, files):
+        parent_id = dir_ids.pop(root)
+        for subdir in subdirs:
+            keys = set(int(digits) for digits in _DIGIT_RUN.findall(subdir))
+            dir_ids[os.path.join(root, subdir)] = add_entry(parent_id, subdir, 1, keys)
+        first_volumes = dict((volume, first) for first, volumes in _rar_volume_sets(files).items() for volume in volumes)
+        member_keys = {}
+        for filename in files:
+            keys = set(int(digits) for digits in _DIGIT_RUN.findall(filename))
+            archive = first_volumes.get(filename, filename)
+            if archive.endswith('.zip') or archive.endswith('.rar'):
+                if archive not in member_keys:
+                    member_keys[archive] = set(int(digits) for member in _list_archive(root + '/' + archive) or []
+                                               for digits in _DIGIT_RUN.findall(member))
+                keys.update(member_keys[archive])
+            add_entry(parent_id, filename, 0, keys)
+
+    _open_archive_cache()
+    _open_tree_index()
+    try:
+        for _ in _walk(search_path, visit):
+            pass
+    finally:
+        _close_archive_cache(search_path, t1)
+        _close_tree_index()
+
+    keys = array('Q', sorted(postings))
+    post_offsets = array('Q', [0])
+    entry_ids = array('I')
+    for key in keys:
+        entry_ids.extend(postings[key])
+        post_offsets.append(len(entry_ids))
+    root_name = search_path.encode('utf8', 'surrogateescape')
+
+    with open(index_name, 'wb') as f:
+        f.write(_MRN_INDEX_HEADER.pack(_MRN_INDEX_MAGIC, len(keys), len(parents), len(names), len(root_name)))
+        for section in (root_name, keys, post_offsets, entry_ids, parents, is_dir, name_offsets, names):
+            f.write(section)
+            f.write(b'\0' * (-f.tell() % 8))
+
+    _write_to_log("MRN index of %s written to %s: %d entries, %d distinct numbers. Time it took to run: %.4f s."
+                  % (search_path, index_name, len(parents) - 1, len(keys), time.time() - t1))
+
+def query_mrn_index(patient_ids, exc_dirs, index_name='MRNIndex.idx'):
+    """Return the same paths_by_patient_id dict as get_matching_paths would for the indexed search path,
+    using an index written by build_mrn_index instead of walking the tree.
+    Only numeric MRNs can be looked up; use get_matching_paths for accession numbers.
+    The index reflects the tree at the time it was built."""
+    mrn_index, other_ids = _build_mrn_index(patient_ids)
+    if other_ids:
+        raise ValueError("Only numeric MRNs can be looked up in an MRN index: %s" % ', '.join(str(i) for i in other_ids))
+
+    with open(index_name, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    views = [buf]
+    try:
+        magic, n_keys, n_entries, names_len, root_len = _MRN_INDEX_HEADER.unpack_from(mm, 0)
+        if magic != _MRN_INDEX_MAGIC:
+            raise ValueError("%s is not an MRN index" % index_name)
+
+        pos = [_MRN_INDEX_HEADER.size]
+        def section(fmt, count):
+            size = count * struct.calcsize(fmt)
+            view = buf[pos[0]:pos[0] + size].cast(fmt)
+            pos[0] += size + (-size % 8)
+            views.append(view)
+            return view
+
+        search_path = bytes(section('B', root_len)).decode('utf8', 'surrogateescape')
+        keys = section('Q', n_keys)
+        post_offsets = section('Q', n_keys + 1)
+        entry_ids = section('I', post_offsets[n_keys])
+        parents = section('i', n_entries)
+        is_dir = section('B', n_entries)
+        name_offsets = section('Q', n_entries + 1)
+        names = section('B', names_len)
+
+        def name(entry_id):
+            return bytes(names[name_offsets[entry_id]:name_offsets[entry_id + 1]]).decode('utf8', 'surrogateescape')
+
+        # whether the contents of a folder would be searched by get_matching_paths
+        searched = {0: True}
+        def is_searched(dir_id):
+            if dir_id not in searched:
+                dir_name = name(dir_id)
+                searched[dir_id] = (is_searched(parents[dir_id]) and not _is_excluded(dir_name, exc_dirs)
+                                    and not _has_different_mrn(dir_name, mrn_index) and not _mrns_in_name(dir_name, mrn_index))
+            return searched[dir_id]
+
+        matches_by_key = {}
+        for key in mrn_index:
+            i = bisect_left(keys, key)
+            if i == n_keys or keys[i] != key:
+                continue
+            for entry_id in entry_ids[post_offsets[i]:post_offsets[i + 1]]:
+                if not is_searched(parents[entry_id]):
+                    continue
+                if is_dir[entry_id] and (_is_excluded(name(entry_id), exc_dirs) or _has_different_mrn(name(entry_id), mrn_index)):
+                    continue
+                matches_by_key.setdefault(key, []).append(entry_id)
+
+        dir_paths = {0: search_path}
+        def dir_path(dir_id):
+            if dir_id not in dir_paths:
+                dir_paths[dir_id] = os.path.join(dir_path(parents[dir_id]), name(dir_id))
+            return dir_paths[dir_id]
+
+        paths_by_patient_id = dict((patient_id, []) for patient_id in patient_ids)
+        for key in matches_by_key:
+            paths = [dir_path(parents[entry_id]) + '/' + name(entry_id) for entry_id in matches_by_key[key]]
+            for patient_id in mrn_index[key]:
+                paths_by_patient_id[patient_id] = list(paths)
+    finally:
+        for view in reversed(views):
+            view.release()
+        mm.close()
+
     return paths_by_patient_id
 
 def write_to_csv(paths_by_patient_id, output_csv, pause_before_copy=False):
@@ -253,67 +1086,680 @@ def write_to_csv(paths_by_patient_id, output_csv, pause_before_copy=False):
         for patient_id in paths_by_patient_id:
             csv_writer.writerow([patient_id] + paths_by_patient_id[patient_id])
 
-    if pause_before_copy:
+    if pause_before_copy and not headless:
+        import easygui
         if not easygui.ynbox("Matches written to " + output_csv + ". Copy matching files to a new directory?"):
             exit(0)
     else:
         _write_to_log("Matches written to " + output_csv + ". Starting to copy matching files.")
 
-def copy_matching_files(paths_by_patient_id, copy_dir):
-    """Write matching files to new directory."""
-    t1 = time.time()
-    potential_duplicates = []
+def _copy_file_data(src, dst, offset=0, hasher=None):
+    """Copy a file's contents, trying the cheapest mechanism first: a reflink clone (FICLONE, on
+    copy-on-write filesystems such as btrfs and XFS), then os.copy_file_range and os.sendfile, which
+    copy inside the kernel, and finally a buffered copy through user space. A mechanism that fails
+    part of the way hands over to the next one at the same offset.
+    With offset > 0, the first offset bytes of dst are kept and the copy resumes from there.
+    With a hasher (from hashlib), the data is hashed as it is copied, which means it all goes through
+    the buffered copy.
+    Returns (mechanism, bytes copied) pairs for the mechanisms that copied data."""
+    used = []
+    with open(src, 'rb') as fsrc, open(dst, 'r+b' if offset else 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(infd).st_size
+        if offset:
+            fdst.truncate(offset)
 
-    _make_dir(os.getcwd() + '/' + copy_dir)
+        if hasher is not None:
+            # the part kept from an earlier run is hashed from dst
+            kept = offset
+            while kept:
+                buf = fdst.read(min(kept, _COPY_BUFSIZE))
+                if not buf:
+                    break
+                hasher.update(buf)
+                kept -= len(buf)
+            size = offset # nothing for the kernel mechanisms to do
 
-    for patient_id in paths_by_patient_id:
-        if len(paths_by_patient_id[patient_id]) == 0:
-            continue
+        if fcntl is not None and sys.platform.startswith('linux') and size > 0 and offset == 0:
+            try:
+                fcntl.ioctl(outfd, _FICLONE, infd)
+                return [('reflink', size)]
+            except OSError:
+                pass
 
-        base_dir = os.getcwd() + '/' + copy_dir + '/' + str(patient_id)
-        _make_dir(base_dir)
+        def kernel_copy(name, copy_chunk):
+            copied = 0
+            try:
+                while offset + copied < size:
+                    n = copy_chunk(offset + copied, min(size - offset - copied, 1 << 30))
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                # not supported for this pair of files, leave the rest to the next mechanism
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF, errno.ENOTSOCK, errno.EPERM):
+                    raise
+            if copied:
+                used.append((name, copied))
+            return copied
 
-        for match in paths_by_patient_id[patient_id]:
-            new_name = base_dir + '/' + os.path.basename(match)
-
-            while os.path.exists(new_name):
-                potential_duplicates.append(os.path.basename(new_name))
-                new_name += '+'
-                
-            #for zip files, just copy once to the main directory, and assume that any zips with the same name are duplicates
-            if match.endswith('.zip') or match.endswith('.rar'):
-                new_name = os.getcwd() + '/' + copy_dir + '/' + os.path.basename(match)
-                if os.path.exists(new_name):
-                    continue
-                
-            if '.' in os.path.basename(match):
-                try:
-                    copyfile(match, new_name) # no exception thrown when overwriting
-                except:
-                    print("Unexpected error in copying file %s: %s" % (match, str(sys.exc_info()[0])))
+        if hasattr(os, 'copy_file_range') and offset < size:
+            offset += kernel_copy('copy_file_range', lambda pos, count: os.copy_file_range(infd, outfd, count, pos, pos))
+        if hasattr(os, 'sendfile') and offset < size:
+            os.lseek(outfd, offset, os.SEEK_SET)
+            offset += kernel_copy('sendfile', lambda pos, count: os.sendfile(outfd, infd, pos, count))
+
+        # buffered copy of whatever is left, until EOF in case the file grew
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        copied = 0
+        while True:
+            buf = fsrc.read(_COPY_BUFSIZE)
+            if not buf:
+                break
+            fdst.write(buf)
+            if hasher is not None:
+                hasher.update(buf)
+            copied += len(buf)
+        if copied:
+            used.append(('buffered', copied))
+
+    return used
+
+class _CopyEngine(object):
+    """Copies matches into copy_dir on a pool of threads. Folders are split into one job per file,
+    so that a patient folder with thousands of small files is spread over all the workers.
+    At most max_pending file copies wait in the pool; beyond that, copy_match blocks until the
+    workers catch up.
+    With dedup, a file whose content is identical to a file already copied is hardlinked to that
+    copy instead of being written again.
+    With a checksum algorithm ('sha256' or 'blake2b'), each file is hashed while it is copied, and
+    finish writes a manifest of the checksums to each patient folder (see verify_copies).
+    With extract_archives, only the members of a matching .zip/.rar whose names contain the MRN are
+    extracted, into a folder named after the archive in the patient's folder."""
+
+    def __init__(self, copy_dir, workers=4, max_pending=1024, dedup=False, checksum=None, extract_archives=False):
+        if checksum is not None and checksum not in _CHECKSUM_ALGORITHMS:
+            raise ValueError("Unsupported checksum algorithm: %s" % checksum)
+        self.copy_dir = os.path.abspath(copy_dir)
+        self.dedup = dedup
+        self.checksum = checksum
+        self.extract_archives = extract_archives
+        self.t1 = time.time()
+        self.potential_duplicates = []
+        self.file_cnt = 0
+        self.byte_cnt = 0
+        self.mechanism_bytes = {} # bytes copied by each copy mechanism (see _copy_file_data)
+        self.mechanism_files = {}
+        self.skipped_cnt = 0
+        self.resumed_cnt = 0
+        self.linked_cnt = 0
+        self.linked_bytes = 0
+        self.error_cnt = 0
+        self._copies_by_hash = {} # for dedup: (src, dst, copy finished event) of every file, by size and partial hash
+        self._full_hashes = {} # for dedup: full hash of each copy compared so far, by destination
+        self._collisions = [] # (first copy, '+' copy) for each name collision
+        self._checksums = {} # hex digest of each file copied, by destination
+        self._reserved = set()
+        self._dir_stats = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+        try:
+            os.makedirs(self.copy_dir, exist_ok=True)
+        except OSError as e:
+            _write_to_log("Could not create copy folder %s: %s" % (self.copy_dir, str(e)))
+            self.error_cnt += 1
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        if copy_journal_name is not None:
+            self._open_journal(self.copy_dir + '/' + copy_journal_name)
+
+    def _open_journal(self, journal_name):
+        """Open the copy journal, which records where each match was copied to and which files are complete,
+        so that an interrupted copy can be resumed."""
+        try:
+            self._journal = sqlite3.connect(journal_name, check_same_thread=False)
+            self._journal.execute("PRAGMA journal_mode=WAL")
+            self._journal.execute("PRAGMA synchronous=NORMAL")
+            # paths are stored as os.fsencode() bytes, since names that are not valid UTF-8 cannot be stored as TEXT
+            self._journal.execute("CREATE TABLE IF NOT EXISTS matches (patient_id TEXT, src BLOB, dst BLOB, duplicates TEXT, "
+                                "PRIMARY KEY (patient_id, src))")
+            self._journal.execute("CREATE TABLE IF NOT EXISTS files (dst BLOB PRIMARY KEY, src BLOB, size INTEGER, mtime INTEGER, done INTEGER)")
+            self._journal.execute("CREATE TABLE IF NOT EXISTS checksums (dst BLOB PRIMARY KEY, algorithm TEXT, digest TEXT)")
+            self._journal.commit()
+        except sqlite3.Error as e:
+            _write_to_log("Could not open copy journal %s: %s" % (journal_name, str(e)))
+            self._journal = None
+
+    def _query_journal(self, sql, args):
+        """Returns the first row of a journal query, or None if there is none or the journal cannot be read,
+        in which case the copy goes ahead as if there was no journal."""
+        if self._journal is None:
+            return None
+        with self._journal_lock:
+            try:
+                return self._journal.execute(sql, args).fetchone()
+            except (sqlite3.Error, ValueError) as e:
+                _write_to_log("Could not read copy journal: %s" % str(e), print_to_screen=False)
+                return None
+
+    def _write_journal(self, sql, args):
+        if self._journal is None:
+            return
+        with self._journal_lock:
+            try:
+                with self._journal:
+                    self._journal.execute(sql, args)
+            except (sqlite3.Error, ValueError) as e:
+                _write_to_log("Could not update copy journal: %s" % str(e), print_to_screen=False)
+
+    def copy_match(self, patient_id, match):
+        """Copy one matching file or folder into the patient's folder in copy_dir. If the name is taken,
+        '+' is added to it. Matching .zip/.rar files are copied once to copy_dir itself, unless their
+        matching members are extracted (extract_archives)."""
+        base_dir = self.copy_dir + '/' + str(patient_id)
+        is_archive = _is_archive(match)
+        # archives that matched by their own name, not by their members, are copied whole
+        members = None
+        if is_archive and self.extract_archives:
+            first_volume = _first_rar_volume(match)
+            if first_volume is None:
+                members = _matching_members(match, patient_id)
+            elif _matching_members(first_volume, patient_id):
+                return # extracted with the first volume of its set
+
+        # destination names are handed out under a lock, so that concurrent copies never pick the same one
+        with self._lock:
+            _make_dir(base_dir)
+
+            # a match that an earlier, interrupted run already started goes back to the same place
+            assigned = self._query_journal("SELECT dst, duplicates FROM matches WHERE patient_id = ? AND src = ?",
+                                           (str(patient_id), os.fsencode(match)))
+            if assigned is not None:
+                new_name = os.fsdecode(assigned[0])
+                duplicates = json.loads(assigned[1])
+                self.potential_duplicates.extend(duplicates)
             else:
-                try:
-                    copytree(match, new_name)
-                except:
-                    _write_to_log("Unexpected error in copying directory %s: %s" % (match, str(sys.exc_info()[0])))
+                new_name = base_dir + '/' + (os.path.splitext(os.path.basename(match))[0] if members else os.path.basename(match))
+                duplicates = []
+
+                while os.path.exists(new_name) or new_name in self._reserved:
+                    duplicates.append(os.path.basename(new_name))
+                    new_name += '+'
+                self.potential_duplicates.extend(duplicates)
+
+                #for zip files, just copy once to the main directory, and assume that any zips with the same name are duplicates
+                if is_archive and not members:
+                    new_name = self.copy_dir + '/' + os.path.basename(match)
+                    if os.path.exists(new_name) or new_name in self._reserved:
+                        return
+
+                self._write_journal("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?)",
+                                    (str(patient_id), os.fsencode(match), os.fsencode(new_name), json.dumps(duplicates)))
 
-    _write_to_log("Copy complete. Time it took to run: %.4f s.\n"  % (time.time() - t1))
+            self._reserved.add(new_name)
+            if duplicates and not (is_archive and not members):
+                self._collisions.append((os.path.dirname(new_name) + '/' + duplicates[0], new_name))
 
-    if len(potential_duplicates) > 0:
-        easygui.msgbox('Copy complete. Potential duplicates detected. Duplicates will have "+" added to the end of their name. See duplicates.log file.')
+        if members:
+            self._submit(self._extract_members, match, members, new_name)
+        elif '.' in os.path.basename(match):
+            self._submit(self._copy_file, match, new_name, False)
+        else:
+            self._copy_tree(match, new_name)
+
+    def _copy_tree(self, src, dst):
+        """Recreate the folders of src under dst and schedule each file for copying, like copytree."""
+        def onerror(e):
+            _write_to_log("Unexpected error in copying directory %s: %s" % (src, str(e)))
+            with self._lock:
+                self.error_cnt += 1
+
+        for root, subdirs, files in os.walk(src, onerror=onerror, followlinks=True):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            try:
+                os.makedirs(dst_root, exist_ok=True)
+            except OSError as e:
+                onerror(e)
+                subdirs[:] = []
+                continue
+
+            with self._lock:
+                self._dir_stats.append((root, dst_root))
+            for filename in files:
+                self._submit(self._copy_file, os.path.join(root, filename), os.path.join(dst_root, filename), True)
+
+    def _submit(self, fn, *args):
+        self._slots.acquire()
         try:
-            with io.open(copy_dir + '/duplicates.log', 'w', encoding='utf8') as f:
-                f.write('\n'.join(potential_duplicates))
+            future = self._pool.submit(fn, *args)
         except:
-            print("Unexpected error while writing duplicate log: " % str(sys.exc_info()[0]))
-    else:        
-        easygui.msgbox('Copy complete.')
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+
+    def _resume_offset(self, src, dst, st):
+        """Returns how much of dst an earlier run already copied from src (unchanged since), or None if dst is complete."""
+        row = self._query_journal("SELECT src, size, mtime, done FROM files WHERE dst = ?", (os.fsencode(dst),))
+        if row is None or tuple(row[:3]) != (os.fsencode(src), st.st_size, st.st_mtime_ns):
+            return 0
+        try:
+            copied = os.path.getsize(dst)
+        except OSError:
+            return 0
+
+        if row[3] and copied == st.st_size:
+            return None
+        if copied > st.st_size or copied == 0:
+            return 0
+
+        # only trust the partial copy if its last block matches the source
+        tail = min(copied, 64 * 1024)
+        with open(src, 'rb') as fsrc, open(dst, 'rb') as fdst:
+            fsrc.seek(copied - tail)
+            fdst.seek(copied - tail)
+            if fsrc.read(tail) != fdst.read(tail):
+                return 0
+        return copied
+
+    def _copy_file(self, src, dst, preserve_stat):
+        try:
+            st = os.stat(src)
+            offset = self._resume_offset(src, dst, st)
+            if offset is None:
+                self._skip_copied(dst)
+                return
+
+            self._write_journal("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, 0)",
+                                (os.fsencode(dst), os.fsencode(src), st.st_size, st.st_mtime_ns))
+            hasher = hashlib.new(self.checksum) if self.checksum is not None else None
+            key, done = self._register_copy(src, dst, st) if self.dedup and st.st_size > 0 else (None, None)
+            try:
+                linked_to = self._link_identical(src, dst, st, key) if done is not None else None
+                if linked_to is not None:
+                    used = []
+                    if hasher is not None:
+                        with self._lock:
+                            digest = self._checksums.get(linked_to)
+                        self._record_checksum(dst, digest or _full_hash(dst, self.checksum).hex())
+                else:
+                    used = _copy_file_data(src, dst, offset, hasher) # no exception thrown when overwriting
+                    if preserve_stat:
+                        copystat(src, dst)
+                    if hasher is not None:
+                        self._record_checksum(dst, hasher.hexdigest())
+            finally:
+                if done is not None:
+                    done.set()
+            self._write_journal("UPDATE files SET done = 1 WHERE dst = ?", (os.fsencode(dst),))
+        except:
+            _write_to_log("Unexpected error in copying file %s: %s" % (src, str(sys.exc_info()[0])))
+            with self._lock:
+                self.error_cnt += 1
+            return
+
+        with self._lock:
+            self.file_cnt += 1
+            if offset:
+                self.resumed_cnt += 1
+            for mechanism, size in used:
+                self.byte_cnt += size
+                self.mechanism_bytes[mechanism] = self.mechanism_bytes.get(mechanism, 0) + size
+                self.mechanism_files[mechanism] = self.mechanism_files.get(mechanism, 0) + 1
+
+    def _extract_members(self, archive_file, members, dst):
+        """Extract members of a .zip/.rar file under dst, streaming each one out of the archive.
+        If the archive, or one of the members, cannot be read (e.g. an unsupported compression method, an
+        encrypted member, or a compressed .rar member without unrar), it is copied whole to copy_dir instead."""
+        try:
+            st = os.stat(archive_file)
+            if archive_file.endswith('.zip'):
+                archive = ZipFile(archive_file)
+            else:
+                from rarfile import RarFile
+                archive = RarFile(archive_file)
+        except Exception as e:
+            _write_to_log("Could not read %s, copying the whole archive instead: %s" % (archive_file, str(e)))
+            self._copy_whole_archive(archive_file, dst)
+            return
+
+        with archive:
+            for member in members:
+                if not self._extract_member(archive, archive_file, st, member, dst):
+                    _write_to_log("Copying the whole archive %s instead of extracting from it" % archive_file)
+                    self._copy_whole_archive(archive_file, dst)
+                    return
+
+    def _copy_whole_archive(self, archive_file, dst):
+        """Copy an archive that could not be extracted to copy_dir, like archives that are not extracted,
+        and remove the folders left empty under dst."""
+        for root, subdirs, files in os.walk(dst, topdown=False):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+        whole_copy = self.copy_dir + '/' + os.path.basename(archive_file)
+        with self._lock:
+            if whole_copy in self._reserved:
+                return
+            self._reserved.add(whole_copy)
+        self._copy_file(archive_file, whole_copy, False)
+
+    def _extract_member(self, archive, archive_file, st, member, dst_dir):
+        """Extract one member of an open archive. Returns False if the member cannot be read from the archive,
+        and True otherwise, including when the member is skipped or could not be written."""
+        rel_path = os.path.normpath(member.lstrip('/'))
+        if member.endswith('/'):
+            return True
+        if rel_path.startswith('..') or os.path.isabs(rel_path):
+            _write_to_log("Not extracting %s from %s, because its path leads outside the copy folder" % (member, archive_file))
+            return True
+        dst = os.path.join(dst_dir, rel_path)
+
+        try:
+            info = archive.getinfo(member)
+            if hasattr(info, 'isdir') and info.isdir():
+                return True
+
+            # the journal keeps the archive as the source of each member
+            row = self._query_journal("SELECT src, size, mtime, done FROM files WHERE dst = ?", (os.fsencode(dst),))
+            if row == (os.fsencode(archive_file), info.file_size, st.st_mtime_ns, 1) and os.path.getsize(dst) == info.file_size:
+                self._skip_copied(dst)
+                return True
+
+            self._write_journal("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, 0)",
+                                (os.fsencode(dst), os.fsencode(archive_file), info.file_size, st.st_mtime_ns))
+            hasher = hashlib.new(self.checksum) if self.checksum is not None else None
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            size = 0
+            with archive.open(member) as fsrc, open(dst, 'wb') as fdst:
+                while True:
+                    buf = fsrc.read(_COPY_BUFSIZE)
+                    if not buf:
+                        break
+                    fdst.write(buf)
+                    if hasher is not None:
+                        hasher.update(buf)
+                    size += len(buf)
+            if hasher is not None:
+                self._record_checksum(dst, hasher.hexdigest())
+            self._write_journal("UPDATE files SET done = 1 WHERE dst = ?", (os.fsencode(dst),))
+        except OSError:
+            _write_to_log("Unexpected error in extracting %s from %s: %s" % (member, archive_file, str(sys.exc_info()[0])))
+            with self._lock:
+                self.error_cnt += 1
+            return True
+        except Exception as e:
+            # errors other than OSError come from the archive module, the member itself cannot be read
+            _write_to_log("Could not read %s from %s: %s" % (member, archive_file, str(e)))
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+            return False
+
+        with self._lock:
+            self.file_cnt += 1
+            self.byte_cnt += size
+            self.mechanism_bytes['extracted'] = self.mechanism_bytes.get('extracted', 0) + size
+            self.mechanism_files['extracted'] = self.mechanism_files.get('extracted', 0) + 1
+        return True
+
+    def _skip_copied(self, dst):
+        """Account for a file that an earlier run already copied completely."""
+        if self.checksum is not None:
+            row = self._query_journal("SELECT digest FROM checksums WHERE dst = ? AND algorithm = ?", (os.fsencode(dst), self.checksum))
+            self._record_checksum(dst, row[0] if row is not None else _full_hash(dst, self.checksum).hex())
+        with self._lock:
+            self.skipped_cnt += 1
+
+    def _record_checksum(self, dst, digest):
+        with self._lock:
+            self._checksums[dst] = digest
+        self._write_journal("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?)", (os.fsencode(dst), self.checksum, digest))
+
+    def _register_copy(self, src, dst, st):
+        """Add a file to the dedup candidates, under its size and a hash of the start and end of the file,
+        which is read once per file. Returns the candidates' key and an event to set once dst has been written."""
+        key = (st.st_size, _partial_hash(src))
+        done = threading.Event()
+        with self._lock:
+            self._copies_by_hash.setdefault(key, []).append((src, dst, done))
+        return key, done
+
+    def _get_full_hash(self, dst):
+        """Full hash of a finished copy, hashed once however many files are compared with it."""
+        with self._lock:
+            digest = self._full_hashes.get(dst)
+        if digest is None:
+            digest = _full_hash(dst)
+            with self._lock:
+                self._full_hashes[dst] = digest
+        return digest
+
+    def _link_identical(self, src, dst, st, key):
+        """Hardlink dst to an earlier copy of a file with the same content as src, if there is one.
+        Only the earlier copies with the same size and partial hash (see _register_copy) are compared,
+        by a full hash. Returns the copy that dst was linked to, or None."""
+        with self._lock:
+            candidates = self._copies_by_hash[key]
+            candidates = candidates[:[c[1] for c in candidates].index(dst)]
+
+        src_hash = None
+        for other_src, other_dst, other_done in candidates:
+            other_done.wait()
+            try:
+                if src_hash is None:
+                    src_hash = _full_hash(src)
+                if self._get_full_hash(other_dst) != src_hash:
+                    continue
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.link(other_dst, dst)
+            except OSError:
+                # e.g. the copy folder is on a filesystem without hardlinks
+                continue
+
+            with self._lock:
+                self.linked_cnt += 1
+                self.linked_bytes += st.st_size
+            return other_dst
+
+        return None
+
+    def finish(self):
+        """Wait for all copies, report throughput and write the list of potential duplicates.
+        Returns the number of files that could not be copied."""
+        self._pool.shutdown(wait=True)
+
+        # like copytree, give folders their source's timestamps once their contents are written
+        for src, dst in reversed(self._dir_stats):
+            try:
+                copystat(src, dst)
+            except OSError:
+                pass
+
+        elapsed = time.time() - self.t1
+        _write_to_log("Copy complete. %d files, %.1f MB copied. Time it took to run: %.4f s (%.1f MB/s).\n"
+                      % (self.file_cnt, self.byte_cnt / 1e6, elapsed, self.byte_cnt / 1e6 / max(elapsed, 1e-9)))
+        if self.skipped_cnt or self.resumed_cnt:
+            _write_to_log("%d files already copied by an earlier run were skipped, and %d partial copies were resumed."
+                          % (self.skipped_cnt, self.resumed_cnt))
+        if self.error_cnt:
+            _write_to_log("%d files or folders could not be copied, see the errors above." % self.error_cnt)
+        if self.linked_cnt:
+            _write_to_log("%d files (%.1f MB) had the same content as a file already copied, and were hardlinked to it instead."
+                          % (self.linked_cnt, self.linked_bytes / 1e6))
+        if self._journal is not None:
+            self._journal.close()
+        if self.checksum is not None:
+            _write_manifests(self.copy_dir, self._checksums, self.checksum)
+        if self.mechanism_bytes:
+            _write_to_log("Copy mechanisms used: " + ", ".join("%s: %.1f MB in %d files" % (m, self.mechanism_bytes[m] / 1e6, self.mechanism_files[m])
+                                                               for m in sorted(self.mechanism_bytes)))
+
+        if len(self.potential_duplicates) > 0:
+            _show_message('Copy complete. Potential duplicates detected. Duplicates will have "+" added to the end of their name. See duplicates.log file.')
+            try:
+                with io.open(self.copy_dir + '/duplicates.log', 'w', encoding='utf8') as f:
+                    if self.dedup:
+                        f.write(self._classify_duplicates())
+                    else:
+                        f.write('\n'.join(self.potential_duplicates))
+            except:
+                print("Unexpected error while writing duplicate log: " % str(sys.exc_info()[0]))
+        else:
+            _show_message('Copy complete.')
+
+        return self.error_cnt
+
+    def _classify_duplicates(self):
+        """Sort the name collisions of this copy by whether the '+' copy has the same content as the first one."""
+        identical = []
+        different = []
+        for first, other in self._collisions:
+            if _same_content(first, other):
+                identical.append(os.path.basename(other))
+            else:
+                different.append(os.path.basename(other))
+
+        return ('True duplicates (same content, stored once):\n' + '\n'.join(identical) +
+                '\n\nDifferent content with the same name:\n' + '\n'.join(different) +
+                '\n\nAll name collisions:\n' + '\n'.join(self.potential_duplicates))
+
+def _partial_hash(path):
+    """Hash of a file's size and its first and last 64 KB, to rule out most files of the same size cheaply."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h = hashlib.blake2b(str(size).encode())
+        h.update(f.read(64 * 1024))
+        if size > 128 * 1024:
+            f.seek(-64 * 1024, os.SEEK_END)
+            h.update(f.read())
+    return h.digest()
+
+def _full_hash(path, algorithm='blake2b'):
+    """Hash of a file's whole content."""
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(_COPY_BUFSIZE), b''):
+            h.update(buf)
+    return h.digest()
+
+def _same_content(path1, path2):
+    """Returns True if two files, or two folders and everything in them, have the same content."""
+    try:
+        if os.path.samefile(path1, path2):
+            return True
+        if os.path.isdir(path1) and os.path.isdir(path2):
+            listing1 = sorted(os.listdir(path1))
+            if listing1 != sorted(os.listdir(path2)):
+                return False
+            return all(_same_content(os.path.join(path1, name), os.path.join(path2, name)) for name in listing1)
+        if os.path.isdir(path1) or os.path.isdir(path2):
+            return False
+        return (os.path.getsize(path1) == os.path.getsize(path2) and _partial_hash(path1) == _partial_hash(path2)
+                and _full_hash(path1) == _full_hash(path2))
+    except OSError:
+        return False
+
+def _write_manifests(copy_dir, checksums, algorithm):
+    """Write the checksums of copied files to manifest.<algorithm> in each patient folder of copy_dir, with
+    paths relative to the folder. Files copied to copy_dir itself (archives) go in a manifest there."""
+    manifests = {}
+    for dst, digest in checksums.items():
+        rel_path = os.path.relpath(dst, copy_dir).replace(os.sep, '/')
+        folder, _, rest = rel_path.partition('/')
+        if rest:
+            manifests.setdefault(folder, []).append((rest, digest))
+        else:
+            manifests.setdefault('', []).append((rel_path, digest))
+
+    for folder, entries in manifests.items():
+        manifest = os.path.join(copy_dir, folder, 'manifest.' + algorithm)
+        try:
+            with io.open(manifest, 'w', encoding='utf8') as f:
+                for rel_path, digest in sorted(entries):
+                    f.write('%s  %s\n' % (digest, rel_path))
+        except OSError as e:
+            _write_to_log("Could not write checksum manifest %s: %s" % (manifest, str(e)))
+
+def verify_copies(copy_dir, workers=4):
+    """Re-hash the copied files against the manifests in copy_dir written by a copy with checksums.
+    Only the copies are read. Returns the paths of files that are missing or whose content differs."""
+    t1 = time.time()
+    expected = []
+    for root, subdirs, files in os.walk(copy_dir):
+        for filename in files:
+            algorithm = filename[len('manifest.'):]
+            if not filename.startswith('manifest.') or algorithm not in _CHECKSUM_ALGORITHMS:
+                continue
+            with io.open(os.path.join(root, filename), encoding='utf8') as f:
+                for line in f:
+                    digest, _, rel_path = line.rstrip('\n').partition('  ')
+                    if rel_path:
+                        expected.append((os.path.join(root, rel_path), algorithm, digest))
+
+    def check(entry):
+        path, algorithm, digest = entry
+        try:
+            return _full_hash(path, algorithm).hex() == digest
+        except OSError:
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failed = [entry[0] for entry, ok in zip(expected, pool.map(check, expected)) if not ok]
+
+    _write_to_log("Verification complete. %d files checked, %d missing or different. Time it took to run: %.4f s."
+                  % (len(expected), len(failed), time.time() - t1))
+    for path in failed:
+        _write_to_log("Checksum mismatch: " + path, print_to_screen=False)
+    return failed
+
+def copy_matching_files(paths_by_patient_id, copy_dir, workers=4, dedup=False, checksum=None, extract_archives=False):
+    """Write matching files to new directory, copying up to workers files at a time.
+    With dedup, files with identical content are only stored once, with checksum ('sha256' or
+    'blake2b') a checksum manifest is written to each patient folder, and with extract_archives only
+    the matching members of .zip/.rar files are copied (see _CopyEngine).
+    Returns the number of files that could not be copied."""
+    engine = _CopyEngine(copy_dir, workers, dedup=dedup, checksum=checksum, extract_archives=extract_archives)
+    for patient_id in paths_by_patient_id:
+        for match in paths_by_patient_id[patient_id]:
+            engine.copy_match(patient_id, match)
+
+    return engine.finish()
+
+def search_and_copy(patient_ids, search_path, exc_dirs, copy_dir, workers=1, copy_workers=4, queue_size=1024, dedup=False,
+                    checksum=None, extract_archives=False):
+    """Search like get_matching_paths and copy the matches like copy_matching_files, but start copying each
+    match as soon as it is found, so that copying overlaps with the search. copy_dir is not searched, so
+    that the files being copied are not found again when it is inside search_path.
+    At most queue_size files wait to be copied; beyond that the search waits for the copy to catch up.
+    Returns the matching paths for each MRN, like get_matching_paths."""
+    paths_by_patient_id = dict((patient_id, []) for patient_id in patient_ids)
+    engine = _CopyEngine(copy_dir, copy_workers, queue_size, dedup, checksum, extract_archives)
+    for patient_id, path in iter_matching_paths(patient_ids, search_path, exc_dirs, workers=workers, exc_paths=[copy_dir]):
+        paths_by_patient_id[patient_id].append(path)
+        engine.copy_match(patient_id, path)
+
+    engine.finish()
+    return paths_by_patient_id
 
 def main():
     """Starting point for script"""
     # Default parameters. Can be converted to UI options if necessary.
     output_csv = None#'MRN_Matches.csv'
     copy_dir = 'FileCopies'
+    search_workers = 8
+    copy_workers = 4
+    pipeline_copy = output_csv is None # copy while searching, unless matches are written out first
+    dedup_copies = False # store files with identical content once, as hardlinks
+    checksum = None # 'sha256' or 'blake2b' to write a checksum manifest to each patient folder while copying
+    verify_after_copy = False # re-hash the copies against the manifests
+    extract_archives = False # extract only the matching members of .zip/.rar files, instead of copying them whole
     logname = None#"FileCopyLogs_" + time.strftime("%m%d%H%M") + ".log"
 
     # Ask user for inputs
@@ -323,15 +1769,105 @@ def main():
     else:
         [patient_ids, search_path, exc_dirs] = ret
 
-    # Get matching files and directories for each MRN
-    paths_by_patient_id = get_matching_paths(patient_ids, search_path, exc_dirs)
+    # Search and copy at the same time
+    if pipeline_copy:
+        search_and_copy(patient_ids, search_path, exc_dirs, copy_dir, workers=search_workers, copy_workers=copy_workers,
+                        dedup=dedup_copies, checksum=checksum, extract_archives=extract_archives)
+    else:
+        # Get matching files and directories for each MRN
+        paths_by_patient_id = get_matching_paths(patient_ids, search_path, exc_dirs, workers=search_workers, exc_paths=[copy_dir])
+
+        # Write matches to csv
+        if output_csv is not None:
+            write_to_csv(paths_by_patient_id, output_csv)
+
+        # Write matching files to new directory
+        copy_matching_files(paths_by_patient_id, copy_dir, workers=copy_workers, dedup=dedup_copies, checksum=checksum,
+                            extract_archives=extract_archives)
+
+    if verify_after_copy and checksum is not None:
+        verify_copies(copy_dir, workers=copy_workers)
+
+def cli(argv=None):
+    """Command line entry point, for running without any dialogs (e.g. scheduled or in parallel batches).
+    Searches each of the search roots for the MRNs in mrn_file and copies the matches like main.
+    Returns the exit code: 0 on success, 1 if the MRN list or a search root cannot be read, 3 if nothing
+    matched, and 4 if some matches could not be copied or verified. Invalid arguments exit with code 2
+    (argparse raises SystemExit)."""
+    global headless, logname
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search folders for files and folders named with MRNs/accession numbers, "
+                                                 "and copy them to a folder per MRN.")
+    parser.add_argument('mrn_file', help="text file with MRNs/accession numbers (one per line, or separated by commas), "
+                                         "or an .xls/.xlsx sheet")
+    parser.add_argument('search_roots', nargs='+', help="folders to search")
+    parser.add_argument('--column', type=int, default=0, help="column of the MRNs in an excel sheet (0 for column A)")
+    parser.add_argument('--exclude', action='append', metavar='NAME',
+                        help="exclude subfolders whose name contains NAME (can be repeated; default: #recycle)")
+    parser.add_argument('--copy-dir', default='FileCopies', help="folder to copy matches to, absolute or relative to the current folder")
+    parser.add_argument('--no-copy', action='store_true', help="only search, e.g. with --output-csv")
+    parser.add_argument('--output-csv', help="write the matching paths for each MRN to this csv")
+    def positive_int(value):
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+        if number < 1:
+            raise argparse.ArgumentTypeError("%r is not a positive number" % value)
+        return number
+
+    parser.add_argument('--search-workers', type=positive_int, default=8)
+    parser.add_argument('--copy-workers', type=positive_int, default=4)
+    parser.add_argument('--dedup', action='store_true', help="store files with identical content once, as hardlinks")
+    parser.add_argument('--checksum', choices=_CHECKSUM_ALGORITHMS, help="write a checksum manifest to each patient folder")
+    parser.add_argument('--verify', action='store_true', help="re-hash the copies against the manifests after copying")
+    parser.add_argument('--extract-archives', action='store_true', help="extract only the matching members of .zip/.rar files")
+    parser.add_argument('--log', help="also append messages to this file")
+    args = parser.parse_args(argv)
+
+    headless = True
+    logname = args.log
+    exc_dirs = args.exclude if args.exclude is not None else ["#recycle"]
+
+    try:
+        patient_ids = _read_mrn_list(args.mrn_file, args.column)
+    except (OSError, UnicodeDecodeError) as e:
+        _write_to_log("Could not read MRN list %s: %s" % (args.mrn_file, str(e)))
+        return 1
+    if not patient_ids:
+        _write_to_log("No MRNs found in %s" % args.mrn_file)
+        return 1
+    for search_path in args.search_roots:
+        if not os.path.isdir(search_path):
+            _write_to_log("Search root %s is not a folder" % search_path)
+            return 1
+
+    _write_to_log("Searching for the following patients: " + str(patient_ids))
+    paths_by_patient_id = dict((patient_id, []) for patient_id in patient_ids)
+    for i, search_path in enumerate(args.search_roots):
+        # SearchHist.log gets a section for each root
+        matches = get_matching_paths(patient_ids, search_path, exc_dirs, workers=args.search_workers, append_history=i > 0,
+                                     exc_paths=[args.copy_dir])
+        for patient_id in matches:
+            paths_by_patient_id[patient_id].extend(matches[patient_id])
 
-    # Write matches to csv
-    if output_csv is not None:
-        write_to_csv(paths_by_patient_id, output_csv)
+    if args.output_csv is not None:
+        write_to_csv(paths_by_patient_id, args.output_csv)
+    if not any(paths_by_patient_id.values()):
+        return 3
+    if args.no_copy:
+        return 0
 
-    # Write matching files to new directory
-    copy_matching_files(paths_by_patient_id, copy_dir)
+    failed = copy_matching_files(paths_by_patient_id, args.copy_dir, workers=args.copy_workers, dedup=args.dedup,
+                                 checksum=args.checksum, extract_archives=args.extract_archives)
+    if args.verify and args.checksum is not None:
+        failed += len(verify_copies(args.copy_dir, workers=args.copy_workers))
+
+    return 4 if failed else 0
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        sys.exit(cli())
+    else:
+        main()
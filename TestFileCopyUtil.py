@@ -1,9 +1,92 @@
 import unittest
+import binascii
+import datetime
+import errno
+import io
+import os
 import re
+import shutil
+import struct
+import sys
+import tempfile
+from unittest import mock
+import zipfile
+import zlib
 import FileCopyUtil
+import rarfile
+
+try:
+	from Crypto.Cipher import AES
+except ImportError:
+	AES = None
+
+def _make_rar5(names):
+	"""Return a single volume RAR5 archive of empty stored files with the given names."""
+	def block(data):
+		data = bytes([len(data)]) + data
+		return struct.pack('<L', zlib.crc32(data)) + data
+	blocks = [b'Rar!\x1a\x07\x01\x00', block(b'\x01\x00\x00')]
+	for name in names:
+		name = name.encode('utf8')
+		blocks.append(block(b'\x02\x00\x00\x00\xa4\x03\x00\x01' + bytes([len(name)]) + name))
+	blocks.append(block(b'\x05\x00\x00'))
+	return b''.join(blocks)
+
+def _make_rar3(files):
+	"""Return a RAR3 archive of one byte stored files, from (name, DOS time, extended time field or None)."""
+	def block(btype, flags, body, data=b''):
+		body = struct.pack('<BHH', btype, flags, 7 + len(body)) + body
+		return struct.pack('<H', zlib.crc32(body) & 0xFFFF) + body + data
+	blocks = [b'Rar!\x1a\x07\x00', block(0x73, 0, b'\0' * 6)]
+	for name, dostime, exttime in files:
+		name = name.encode('utf8')
+		header = struct.pack('<LLBLLBBHL', 1, 1, 3, zlib.crc32(b'x'), dostime, 29, 0x30, len(name), 0x20) + name
+		if exttime is None:
+			blocks.append(block(0x74, 0x8000, header, b'x'))
+		else:
+			blocks.append(block(0x74, 0x9000, header + exttime, b'x'))
+	blocks.append(block(0x7b, 0, b''))
+	return b''.join(blocks)
+
+def _make_rar5_times(files):
+	"""Return a RAR5 archive of empty stored files, from (name, unix mtime or None, time record data or None)."""
+	def block(data):
+		data = bytes([len(data)]) + data
+		return struct.pack('<L', zlib.crc32(data)) + data
+	blocks = [b'Rar!\x1a\x07\x01\x00', block(b'\x01\x00\x00')]
+	for name, mtime, htime in files:
+		name = name.encode('utf8')
+		if mtime is None:
+			fields = b'\x00\x00\xa4\x03'
+		else:
+			fields = b'\x02\x00\xa4\x03' + struct.pack('<L', mtime)
+		fields += b'\x00\x01' + bytes([len(name)]) + name
+		if htime is None:
+			blocks.append(block(b'\x02\x00' + fields))
+		else:
+			extra = bytes([len(htime) + 1, 3]) + htime
+			blocks.append(block(b'\x02\x01' + bytes([len(extra)]) + fields + extra))
+	blocks.append(block(b'\x05\x00\x00'))
+	return b''.join(blocks)
 
 class TestFileCopyUtil(unittest.TestCase):
 
+	def setUp(self):
+		# each test runs in a folder of its own, where the search writes SearchHist.log and its caches
+		self.cwd = os.getcwd()
+		self.tmp_dir = tempfile.mkdtemp()
+		os.chdir(self.tmp_dir)
+		FileCopyUtil.headless = True
+
+	def tearDown(self):
+		FileCopyUtil.headless = False
+		FileCopyUtil.logname = None
+		FileCopyUtil._archive_member_matches.clear()
+		FileCopyUtil._rar_first_volumes.clear()
+		FileCopyUtil._rar_listed_dirs.clear()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmp_dir)
+
 	def test_match_mrn(self):
 		pos_test = ['55081', 'scans55081_01', '0055081.txt', 't2scans55081-01']
 		neg_test = ['something completely off', '550810', 'scans155081', '550811.txt']
@@ -25,7 +108,7 @@ class TestFileCopyUtil(unittest.TestCase):
 
 	def test_has_different_mrn(self):
 		pos_test = ['5508141', 'scans1234567_01', '0508141.txt', '5508141_01']
-		neg_test = ['something completely off', '55081', 'scans20161004', 't2scans55081-01']
+		neg_test = ['something completely off', '55081', 'scans20161004', 't2scans55081-01', '2019', '1', '0055081']
 		mrns = [55081]
 
 		for filename in pos_test:
@@ -33,5 +116,673 @@ class TestFileCopyUtil(unittest.TestCase):
 		for filename in neg_test:
 			self.assertFalse(FileCopyUtil._has_different_mrn(filename, mrns))
 
+	def test_find_numbers_in_filenames(self):
+		names = ['55081', 'scans55081_01', '0055081.txt', 't2scans55081-01', '550810', 'scans155081',
+			'1234567_and_55081', 'E123456789.dcm', 'E1234567890', 'nothing here']
+		patient_ids = ['55081', 1234567, 'E123456789', '7654321']
+		matches = FileCopyUtil.find_numbers_in_filenames(patient_ids, names)
+
+		for patient_id in patient_ids:
+			expected = [name for name in names if FileCopyUtil._mrn_in_name(str(patient_id), name)]
+			self.assertEqual(matches[patient_id], expected)
+		self.assertEqual(matches['7654321'], [])
+		self.assertEqual(FileCopyUtil.find_number_in_filename('55081', names), matches['55081'])
+
+	def test_check_archive(self):
+		with zipfile.ZipFile('export.zip', 'w') as zf:
+			zf.writestr('scans55081_01/IM0001.dcm', b'')
+			zf.writestr('0001234567.txt', b'')
+		names = ['export.zip', '55081_export.zip', 'missing.rar']
+		matches = FileCopyUtil.find_numbers_in_filenames(['55081', '1234567', '7654321'], names, self.tmp_dir)
+
+		self.assertEqual(matches['55081'], ['export.zip', '55081_export.zip'])
+		self.assertEqual(matches['1234567'], ['export.zip'])
+		self.assertEqual(matches['7654321'], [])
+		self.assertIsNone(FileCopyUtil._list_archive('missing.rar'))
+
+		archive_file = self.tmp_dir + '/export.zip'
+		self.assertEqual(FileCopyUtil._matching_members(archive_file, '55081'), ['scans55081_01/IM0001.dcm'])
+		self.assertEqual(FileCopyUtil._matching_members(archive_file, '1234567'), ['0001234567.txt'])
+		FileCopyUtil._archive_member_matches.clear()
+		self.assertEqual(FileCopyUtil._matching_members(archive_file, '1234567'), ['0001234567.txt'])
+
+	def test_rar_volume_sets(self):
+		names = ['scan.part02.rar', 'scan.part01.rar', 'scan.part10.rar', 'old.rar', 'old.r00', 'old.r01', 'lone.r00',
+			'single.rar', 'other.part1.rar']
+		self.assertEqual(FileCopyUtil._rar_volume_sets(names), {
+			'scan.part01.rar': ['scan.part01.rar', 'scan.part02.rar', 'scan.part10.rar'],
+			'old.rar': ['old.rar', 'old.r00', 'old.r01']})
+
+		# only the first volume is opened, and a match in it takes the whole set
+		listings = {'dir/scan.part01.rar': ['55081/IM0001.dcm'], 'dir/old.rar': ['IM0001.dcm']}
+		with mock.patch('FileCopyUtil._list_archive', side_effect=listings.get) as list_archive:
+			matches = FileCopyUtil.find_numbers_in_filenames(['55081'], names[:6], 'dir')
+		self.assertEqual(matches['55081'], ['scan.part02.rar', 'scan.part01.rar', 'scan.part10.rar'])
+		self.assertEqual(sorted(args[0] for args, _ in list_archive.call_args_list), ['dir/old.rar', 'dir/scan.part01.rar'])
+
+		# the sets found by the search are reused when copying, without listing 'dir' (which does not exist)
+		with mock.patch('os.listdir') as listdir:
+			self.assertEqual(FileCopyUtil._first_rar_volume('dir/scan.part10.rar'), 'dir/scan.part01.rar')
+			self.assertEqual(FileCopyUtil._first_rar_volume('dir/old.r01'), 'dir/old.rar')
+			self.assertIsNone(FileCopyUtil._first_rar_volume('dir/scan.part01.rar'))
+			self.assertFalse(listdir.called)
+		FileCopyUtil._rar_first_volumes.clear()
+
+		# otherwise each directory is listed once
+		for name in names:
+			open(name, 'w').close()
+		with mock.patch('os.listdir', wraps=os.listdir) as listdir:
+			self.assertEqual(FileCopyUtil._first_rar_volume(self.tmp_dir + '/scan.part02.rar'), self.tmp_dir + '/scan.part01.rar')
+			self.assertEqual(FileCopyUtil._first_rar_volume(self.tmp_dir + '/scan.part10.rar'), self.tmp_dir + '/scan.part01.rar')
+			self.assertIsNone(FileCopyUtil._first_rar_volume(self.tmp_dir + '/other.part1.rar'))
+			self.assertEqual(listdir.call_count, 1)
+
+	def test_read_zip_names(self):
+		small_zip = 'small.zip'
+		with zipfile.ZipFile(small_zip, 'w') as zf:
+			zf.writestr('\u00fc/1234567.txt', b'x')
+			zf.writestr(zipfile.ZipInfo('caf\x82.txt'), b'')
+			zf.comment = b'comment'
+		with open(small_zip, 'rb') as f:
+			data = f.read()
+		sfx_zip = 'sfx.zip'
+		with open(sfx_zip, 'wb') as f:
+			f.write(b'MZ' * 1000 + data)
+		zip64 = 'zip64.zip'
+		with zipfile.ZipFile(zip64, 'w') as zf:
+			for i in range(0x10000):
+				zf.writestr('%d/IM0001.dcm' % i, b'')
+
+		for zip_file in (small_zip, sfx_zip, zip64):
+			with zipfile.ZipFile(zip_file) as zf:
+				self.assertEqual(FileCopyUtil._read_zip_names(zip_file), zf.namelist())
+		with open('broken.zip', 'wb') as f:
+			f.write(data[:len(data) // 2] + data[len(data) // 2 + 1:])
+		self.assertIsNone(FileCopyUtil._read_zip_names('broken.zip'))
+
+	def test_rar_namelist(self):
+		rar_file = 'export.rar'
+		with open(rar_file, 'wb') as f:
+			f.write(_make_rar5(['55081/IM%04d.dcm' % i for i in range(100)] + ['caf\u00e9/0001234567.txt']))
+		self.assertEqual(rarfile.rar_namelist(rar_file), rarfile.RarFile(rar_file).namelist())
+		self.assertEqual(FileCopyUtil._list_archive(rar_file)[-1], 'caf\u00e9/0001234567.txt')
+
+	def test_rar_info_times(self):
+		def dos(*date_time):
+			y, mo, d, h, mi, s = date_time
+			return (y - 1980) << 25 | mo << 21 | d << 16 | h << 11 | mi << 5 | s // 2
+		def utc(*args):
+			return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+		rar3 = _make_rar3([('plain.txt', dos(2019, 5, 17, 13, 45, 30), None),
+			('ext.txt', dos(2019, 5, 17, 13, 45, 30), struct.pack('<H', 0xb << 12 | 0x9 << 8 | 0xc << 4) + b'\x01\x02\x03'
+				+ struct.pack('<L', dos(2018, 1, 2, 3, 4, 6)) + b'\x05' + struct.pack('<L', dos(2020, 12, 31, 23, 59, 58)))])
+		rar5 = _make_rar5_times([('plain.txt', 1600000000, None),
+			('win.txt', None, b'\x0e' + struct.pack('<QQQ', 132000000001234567, 131000000000000000, 133000000000000009)),
+			('unix.txt', None, b'\x07' + struct.pack('<LL', 1500000000, 1400000000))])
+		# date_time, mtime, ctime, atime and arctime, as they were parsed before the times were decoded lazily
+		expected = {
+			(rar3, 'plain.txt'): ((2019, 5, 17, 13, 45, 30), None, None, None, None),
+			(rar3, 'ext.txt'): ((2019, 5, 17, 13, 45, 30), datetime.datetime(2019, 5, 17, 13, 45, 30, 19712),
+				datetime.datetime(2018, 1, 2, 3, 4, 6, 32768), datetime.datetime(2020, 12, 31, 23, 59, 59), None),
+			(rar5, 'plain.txt'): ((2020, 9, 13, 12, 26, 40), utc(2020, 9, 13, 12, 26, 40), None, None, None),
+			(rar5, 'win.txt'): ((2019, 4, 17, 18, 40, 0), utc(2019, 4, 17, 18, 40, 0, 123456), utc(2016, 2, 15, 8, 53, 20),
+				utc(2022, 6, 18, 4, 26, 40), None),
+			(rar5, 'unix.txt'): ((2017, 7, 14, 2, 40, 0), utc(2017, 7, 14, 2, 40), utc(2014, 5, 13, 16, 53, 20), None, None),
+		}
+		fields = ('date_time', 'mtime', 'ctime', 'atime', 'arctime')
+		for (data, name), times in expected.items():
+			info = rarfile.RarFile(io.BytesIO(data)).getinfo(name)
+			self.assertEqual(tuple(getattr(info, field) for field in fields), times)
+
+			# times can be assigned, also before any of them were decoded
+			for field in fields:
+				info = rarfile.RarFile(io.BytesIO(data)).getinfo(name)
+				setattr(info, field, utc(2001, 2, 3))
+				self.assertEqual(tuple(getattr(info, f) for f in fields),
+					tuple(utc(2001, 2, 3) if f == field else t for f, t in zip(fields, times)))
+
+	def test_rar_key_cache(self):
+		cache = rarfile.KeyCache()
+		calls = []
+		def derive(key):
+			return lambda: calls.append(key) or key
+		self.assertEqual(cache.get(('rar5', u'secret', b'salt1', 15), derive(b'k1')), b'k1')
+		self.assertEqual(cache.get(('rar5', b'secret', b'salt1', 15), derive(b'k2')), b'k1')
+		self.assertEqual(cache.get(('rar5', u'secret', b'salt1', 16), derive(b'k3')), b'k3')
+		self.assertEqual(cache.get(('rar3', u'other', b'salt1'), derive(b'k4')), b'k4')
+		self.assertEqual((calls, cache.hits, cache.misses), ([b'k1', b'k3', b'k4'], 1, 3))
+
+		size = rarfile.KEY_CACHE_SIZE
+		rarfile.KEY_CACHE_SIZE = 2
+		try:
+			cache.get(('rar3', u'other', b'salt2'), derive(b'k5'))
+			self.assertEqual(len(cache), 2)
+			self.assertEqual(cache.get(('rar5', u'secret', b'salt1', 15), derive(b'k6')), b'k6')
+		finally:
+			rarfile.KEY_CACHE_SIZE = size
+
+	def test_rar3_s2k(self):
+		salt = b'\x01\x02\x03\x04\x05\x06\x07\x08'
+		# keys from the original per-record Rar3Sha1 loop; the long password goes through the rarbug path
+		for psw, key, iv in (('password', '413960312dec09cdfb250251fe1be37c', 'e32ca60bca0ab1c28908804ee237a3a8'),
+				('y' * 29, '3c3571a7705d85465b2349d92ede1f0d', 'ddba1101846d3ebb00351b5eaab564a7')):
+			self.assertEqual(rarfile.rar3_s2k(psw, salt), (binascii.unhexlify(key), binascii.unhexlify(iv)))
+
+	def test_rar_header_decrypt(self):
+		if AES is None:
+			self.skipTest("pycryptodome is not installed")
+		if not rarfile._have_crypto:
+			self.skipTest("rarfile has no AES")
+
+		# headers under the header key, with comments under another key in between
+		header_key, comment_key = b'h' * 32, b'c' * 32
+		blocks = []
+		for i, key in enumerate([header_key, header_key, comment_key, header_key, comment_key, comment_key, header_key]):
+			iv = os.urandom(16)
+			plain = os.urandom(16 * (i + 1))
+			blocks.append((key, iv, plain, AES.new(key, AES.MODE_CBC, iv).encrypt(plain)))
+		fd = io.BytesIO(b''.join(block[3] for block in blocks))
+
+		parser = rarfile.RAR5Parser('test.rar', None, True, None, False, None)
+		pos = 0
+		with mock.patch.object(rarfile, 'AES_CBC_Decrypt', wraps=rarfile.AES_CBC_Decrypt) as decryptor:
+			for key, iv, plain, enc in blocks:
+				f = parser._header_decrypt(fd, key, iv)
+				dec = b''
+				sizes = [1, 7, 3, 16, 5, 33]
+				while len(dec) < len(plain):
+					dec += f.read(min(sizes[len(dec) % len(sizes)], len(plain) - len(dec)))
+				pos += len(enc)
+				self.assertEqual((dec, fd.tell()), (plain, pos))
+		# a decryptor is only set up when the key changes
+		self.assertEqual(decryptor.call_count, 5)
+
+	def test_blake2sp(self):
+		data = bytes(bytearray(range(256))) * 4099
+		small = rarfile.Blake2SP()
+		for i in range(0, len(data), 61):
+			small.update(data[i:i + 61])
+		self.assertEqual(rarfile.Blake2SP(data).digest(), small.digest())
+		big = rarfile.Blake2SP(data[:100])
+		big.update(data[100:])
+		self.assertEqual(big.digest(), small.digest())
+
+	def test_rar_copy_data(self):
+		data = os.urandom(300000)
+		src_path = 'src.bin'
+		with open(src_path, 'wb') as f:
+			f.write(data)
+		block = rarfile.COPY_BLOCK_SIZE
+		rarfile.COPY_BLOCK_SIZE = 65536
+		try:
+			with open(src_path, 'rb') as src:
+				src.seek(1000)
+				with open('dst.bin', 'wb', 0) as dst:
+					self.assertEqual(rarfile.copy_data(src, dst, 200000), 200000)
+				self.assertEqual(src.tell(), 201000)
+				self.assertEqual(rarfile.copy_data(src, io.BytesIO(), 200000), 99000)
+		finally:
+			rarfile.COPY_BLOCK_SIZE = block
+		with open('dst.bin', 'rb') as f:
+			self.assertEqual(f.read(), data[1000:201000])
+
+	def test_rar_open_hack_copy(self):
+		rar_file = 'export.rar'
+		with open(rar_file, 'wb') as f:
+			f.write(_make_rar3([('55081/IM0001.dcm', 0, None), ('55081/IM0002.dcm', 0, None)]))
+		parser = rarfile.RarFile(rar_file)._file_parser
+		inf = parser.getinfo('55081/IM0002.dcm')
+		archives = []
+		def open_unrar(tmp_name, inf, psw=None, tmpfile=None):
+			archives.append(rarfile.RarFile(tmp_name).namelist())
+			os.unlink(tmp_name)
+		with mock.patch.object(rarfile, 'STDIN_ARCHIVE', None), \
+				mock.patch.object(rarfile, '_ensure_unrar_tool'), \
+				mock.patch.object(parser, '_open_unrar', open_unrar), \
+				mock.patch('os.copy_file_range', wraps=os.copy_file_range) as copy_file_range, \
+				mock.patch('os.sendfile', wraps=os.sendfile) as sendfile:
+			parser._open_hack(inf, None)
+		self.assertTrue(copy_file_range.called or sendfile.called)
+		self.assertEqual(archives, [['55081/IM0002.dcm']])
+
+	def test_rar_feed_error(self):
+		rar_file = 'export.rar'
+		with open(rar_file, 'wb') as f:
+			f.write(_make_rar3([('55081/IM0001.dcm', 0, None)]))
+		parser = rarfile.RarFile(rar_file)._file_parser
+		inf = parser.getinfo('55081/IM0001.dcm')
+		cmd = [sys.executable, '-c', 'import sys; sys.stdin.buffer.read(); sys.stdout.buffer.write(sys.argv[1].encode())']
+		def feed(dst):
+			dst.write(b'x')
+		with rarfile.PipeReader(parser, inf, cmd + ['x'], feed=feed) as f:
+			self.assertEqual(f.read(), b'x')
+		def bad_feed(dst):
+			raise rarfile.BadRarFile('read failed: ' + inf.filename)
+		f = rarfile.PipeReader(parser, inf, cmd + [''], feed=bad_feed)
+		self.assertRaises(rarfile.BadRarFile, f.read)
+		f.close()
+		f = rarfile.PipeReader(parser, inf, cmd + [''], feed=bad_feed)
+		self.assertRaises(rarfile.BadRarFile, f.close)
+
+	def test_archive_cache(self):
+		zip_file = 'export.zip'
+		with zipfile.ZipFile(zip_file, 'w') as zf:
+			zf.writestr('scans55081_01/IM0001.dcm', b'')
+
+		FileCopyUtil._open_archive_cache()
+		self.assertIsNone(FileCopyUtil._get_cached_listing(zip_file, os.stat(zip_file)))
+		FileCopyUtil._list_archive(zip_file)
+		FileCopyUtil._close_archive_cache(self.tmp_dir, 0)
+
+		FileCopyUtil._open_archive_cache()
+		self.assertEqual(FileCopyUtil._get_cached_listing(zip_file, os.stat(zip_file)), ['scans55081_01/IM0001.dcm'])
+		FileCopyUtil._close_archive_cache(self.tmp_dir, 0)
+
+		# entries for archives that no longer exist are evicted
+		os.remove(zip_file)
+		search_start = FileCopyUtil.time.time() + 1
+		FileCopyUtil._open_archive_cache()
+		FileCopyUtil._close_archive_cache(self.tmp_dir, search_start)
+		FileCopyUtil._open_archive_cache()
+		self.assertEqual(FileCopyUtil._archive_cache.execute('SELECT COUNT(*) FROM archives').fetchone()[0], 0)
+		FileCopyUtil._close_archive_cache(self.tmp_dir, 0)
+
+	def test_archive_cache_undecodable_name(self):
+		os.mkdir('tree')
+		zip_file = os.fsdecode(b'tree/caf\xe9.zip')
+		try:
+			zf = zipfile.ZipFile(zip_file, 'w')
+		except (OSError, UnicodeError):
+			self.skipTest("file system does not allow names that are not valid UTF-8")
+		with zf:
+			zf.writestr('scans55081_01/IM0001.dcm', b'')
+
+		for _ in range(2):
+			self.assertEqual(FileCopyUtil.get_matching_paths(['55081'], 'tree', []), {'55081': [zip_file]})
+		FileCopyUtil._open_archive_cache()
+		self.assertEqual(FileCopyUtil._get_cached_listing(zip_file, os.stat(zip_file)), ['scans55081_01/IM0001.dcm'])
+		FileCopyUtil._close_archive_cache('tree', 0)
+
+	def test_parallel_walk(self):
+		for path in ['tree/a/55081_scans/IM1.dcm', 'tree/a/b/0055081.txt', 'tree/a/b/c/1234567_01.dcm',
+				'tree/9999999/55081.txt', 'tree/#recycle/55081.txt', 'tree/d/IM55081.dcm', 'tree/2019/series/1/55081_IM1.dcm']:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			open(path, 'w').close()
+
+		patient_ids = ['55081', '1234567']
+		# without the tree index, directories are only listed, not stat'ed
+		with mock.patch('os.stat', wraps=os.stat) as stat:
+			serial_paths = FileCopyUtil.get_matching_paths(patient_ids, 'tree', ['#recycle'])
+			parallel_paths = FileCopyUtil.get_matching_paths(patient_ids, 'tree', ['#recycle'], workers=4)
+		self.assertFalse([args for args, _ in stat.call_args_list if os.path.isdir(args[0])])
+		self.assertEqual(serial_paths, parallel_paths)
+		self.assertEqual(sorted(serial_paths['55081']), ['tree/2019/series/1/55081_IM1.dcm', 'tree/a/55081_scans', 'tree/a/b/0055081.txt',
+			'tree/d/IM55081.dcm'])
+		self.assertEqual(serial_paths['1234567'], ['tree/a/b/c/1234567_01.dcm'])
+
+		streamed_paths = dict((patient_id, []) for patient_id in patient_ids)
+		for patient_id, path in FileCopyUtil.iter_matching_paths(patient_ids, 'tree', ['#recycle'], workers=4):
+			streamed_paths[patient_id].append(path)
+		self.assertEqual(streamed_paths, serial_paths)
+
+	def test_search_other_ids(self):
+		for path in ['tree/E1234567/IM1.dcm', 'tree/a/E1234567.txt', 'tree/7654321/E1234567.txt']:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			open(path, 'w').close()
+
+		# a folder named after a searched accession number is a match, not a folder of another MRN
+		for patient_ids in (['E1234567'], ['E1234567', '55081']):
+			paths = FileCopyUtil.get_matching_paths(patient_ids, 'tree', [], workers=2)
+			self.assertEqual(sorted(paths['E1234567']), ['tree/E1234567', 'tree/a/E1234567.txt'])
+
+	def test_parallel_walk_backpressure(self):
+		for i in range(30):
+			for j in range(10):
+				os.makedirs(os.path.join(self.tmp_dir, 'd%02d' % i, 's%d' % j))
+		visited = []
+		def visit(root, subdirs, files):
+			visited.append(root)
+
+		walk = FileCopyUtil._walk_parallel(self.tmp_dir, visit, 4, max_pending=8)
+		roots = [next(walk)[0]]
+		FileCopyUtil.time.sleep(0.2)
+		# a consumer that has not pulled further keeps the rest of the tree unlisted
+		self.assertLessEqual(len(visited), 8 + 1)
+		roots.extend(ret[0] for ret in walk)
+		self.assertEqual(roots, [ret[0] for ret in FileCopyUtil._walk(self.tmp_dir, visit)])
+		self.assertEqual(len(roots), 331)
+
+	@mock.patch.object(FileCopyUtil, 'tree_index_name', 'TreeIndex.db')
+	def test_tree_index(self):
+		os.makedirs('tree/a/b')
+		open('tree/a/b/55081.txt', 'w').close()
+
+		paths = FileCopyUtil.get_matching_paths(['55081'], 'tree', [])
+		self.assertEqual(FileCopyUtil.get_matching_paths(['55081'], 'tree', []), paths)
+		self.assertEqual(FileCopyUtil.get_matching_paths(['55081'], 'tree', []), paths)
+
+		# a changed directory is listed again
+		open('tree/a/b/IM55081.dcm', 'w').close()
+		os.utime('tree/a/b', ns=(0, 0))
+		self.assertEqual(sorted(FileCopyUtil.get_matching_paths(['55081'], 'tree', [])['55081']),
+			['tree/a/b/55081.txt', 'tree/a/b/IM55081.dcm'])
+		# and then taken from the index, since its mtime is old enough to be trusted
+		with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+			self.assertEqual(len(FileCopyUtil.get_matching_paths(['55081'], 'tree', [])['55081']), 2)
+		self.assertNotIn('tree/a/b', [args[0] for args, _ in scandir.call_args_list])
+
+		# a directory changed within the mtime granularity of its listing is listed again, even if its mtime stays the same
+		os.mkdir('tree/new')
+		self.assertEqual(len(FileCopyUtil.get_matching_paths(['55081'], 'tree', [])['55081']), 2)
+		st = os.stat('tree/new')
+		open('tree/new/55081.txt', 'w').close()
+		os.utime('tree/new', ns=(st.st_atime_ns, st.st_mtime_ns))
+		self.assertEqual(len(FileCopyUtil.get_matching_paths(['55081'], 'tree', [])['55081']), 3)
+		shutil.rmtree('tree/new')
+
+		# folder names that are not valid UTF-8 can be indexed, and removed from the index
+		try:
+			os.mkdir(os.fsdecode(b'tree/caf\xe9'))
+		except (OSError, UnicodeError):
+			return
+		open(os.fsdecode(b'tree/caf\xe9/55081.txt'), 'w').close()
+		for _ in range(2):
+			self.assertEqual(len(FileCopyUtil.get_matching_paths(['55081'], 'tree', [])['55081']), 3)
+		shutil.rmtree(os.fsdecode(b'tree/caf\xe9'))
+		self.assertEqual(len(FileCopyUtil.get_matching_paths(['55081'], 'tree', [])['55081']), 2)
+
+	def test_mrn_index(self):
+		for path in ['tree/a/55081_scans/1234567.dcm', 'tree/a/b/0055081.txt', 'tree/a/b/c/1234567_01.dcm',
+				'tree/9999999/55081.txt', 'tree/#recycle/55081.txt', 'tree/d/IM55081.dcm']:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			open(path, 'w').close()
+		with zipfile.ZipFile('tree/d/export.zip', 'w') as zf:
+			zf.writestr('1234567/IM0001.dcm', b'')
+
+		FileCopyUtil.build_mrn_index('tree', 'MRNIndex.idx')
+		for patient_ids in (['55081', '1234567'], ['1234567'], [55081, '7654321']):
+			self.assertEqual(FileCopyUtil.query_mrn_index(patient_ids, ['#recycle'], 'MRNIndex.idx'),
+				FileCopyUtil.get_matching_paths(patient_ids, 'tree', ['#recycle']))
+		self.assertRaises(ValueError, FileCopyUtil.query_mrn_index, ['E123456789'], [], 'MRNIndex.idx')
+
+		# IDs with the same MRN get lists of their own
+		paths = FileCopyUtil.query_mrn_index(['55081', 55081], [], 'MRNIndex.idx')
+		self.assertEqual(paths['55081'], paths[55081])
+		self.assertIsNot(paths['55081'], paths[55081])
+
+	def test_copy_journal(self):
+		os.makedirs('tree/55081_scans')
+		os.makedirs('tree/a')
+		with open('tree/55081_scans/IM1.dcm', 'wb') as f:
+			f.write(os.urandom(300000))
+		with open('tree/a/55081.txt', 'w') as f:
+			f.write('first')
+		matches = ['tree/55081_scans', 'tree/a/55081.txt']
+		undecodable = os.fsdecode(b'tree/caf\xe9_55081.txt')
+		try:
+			with open(undecodable, 'w') as f:
+				f.write('caf\xe9')
+			matches.append(undecodable)
+		except (OSError, UnicodeError):
+			pass
+
+		def copy():
+			engine = FileCopyUtil._CopyEngine('copies', 2)
+			for match in matches:
+				engine.copy_match('55081', match)
+			self.assertEqual(engine.finish(), 0)
+			return engine
+
+		engine = copy()
+		self.assertEqual((engine.file_cnt, engine.skipped_cnt), (len(matches), 0))
+
+		# a rerun skips completed files and copies nothing twice
+		engine = copy()
+		self.assertEqual((engine.file_cnt, engine.skipped_cnt, engine.potential_duplicates), (0, len(matches), []))
+
+		# an interrupted copy carries on from where it stopped
+		with open('copies/55081/55081_scans/IM1.dcm', 'r+b') as f:
+			f.truncate(100000)
+		journal = FileCopyUtil.sqlite3.connect('copies/CopyJournal.db')
+		with journal:
+			journal.execute('UPDATE files SET done = 0 WHERE src = ?', (os.fsencode('tree/55081_scans/IM1.dcm'),))
+		journal.close()
+		engine = copy()
+		self.assertEqual((engine.file_cnt, engine.resumed_cnt, engine.skipped_cnt), (1, 1, len(matches) - 1))
+		self.assertEqual(engine.byte_cnt, 200000)
+		self.assertEqual(FileCopyUtil._full_hash('copies/55081/55081_scans/IM1.dcm'), FileCopyUtil._full_hash('tree/55081_scans/IM1.dcm'))
+
+		# a changed source is copied again
+		with open('tree/a/55081.txt', 'w') as f:
+			f.write('second')
+		os.utime('tree/a/55081.txt', ns=(0, 0))
+		engine = copy()
+		self.assertEqual((engine.file_cnt, engine.resumed_cnt, engine.skipped_cnt), (1, 0, len(matches) - 1))
+		with open('copies/55081/55081.txt') as f:
+			self.assertEqual(f.read(), 'second')
+
+		self.assertFalse([name for name in os.listdir('copies/55081') if name.endswith('+')])
+		self.assertEqual(len(os.listdir('copies/55081')), len(matches))
+
+	def test_dedup_copies(self):
+		data = os.urandom(200000)
+		for path, content in [('tree/a/55081.txt', data), ('tree/b/55081.txt', data), ('tree/c/55081.txt', data[:-1] + b'x'),
+				('tree/d/IM55081.dcm', data)]:
+			os.makedirs(os.path.dirname(path))
+			with open(path, 'wb') as f:
+				f.write(content)
+		matches = ['tree/a/55081.txt', 'tree/b/55081.txt', 'tree/c/55081.txt', 'tree/d/IM55081.dcm']
+
+		engine = FileCopyUtil._CopyEngine('copies', 2, dedup=True)
+		for match in matches:
+			engine.copy_match('55081', match)
+		self.assertEqual(engine.finish(), 0)
+
+		# identical content is stored once, a '+' copy with other content is kept as it is
+		self.assertEqual(engine.linked_cnt, 2)
+		for name in ('55081.txt', '55081.txt+', 'IM55081.dcm'):
+			self.assertEqual(os.stat('copies/55081/' + name).st_nlink, 3)
+		self.assertEqual(os.stat('copies/55081/55081.txt++').st_nlink, 1)
+		with open('copies/55081/55081.txt++', 'rb') as f:
+			self.assertEqual(f.read(), data[:-1] + b'x')
+
+		with open('copies/duplicates.log') as f:
+			identical, different, collisions = f.read().split('\n\n')
+		self.assertEqual(identical.splitlines()[1:], ['55081.txt+'])
+		self.assertEqual(different.splitlines()[1:], ['55081.txt++'])
+		self.assertEqual(collisions.splitlines()[1:], ['55081.txt', '55081.txt', '55081.txt+'])
+
+		# without hardlinks, identical files are copied normally
+		with mock.patch('os.link', side_effect=OSError(errno.EPERM, 'Operation not permitted')):
+			engine = FileCopyUtil._CopyEngine('copies2', 2, dedup=True)
+			for match in matches:
+				engine.copy_match('55081', match)
+			self.assertEqual(engine.finish(), 0)
+		self.assertEqual((engine.linked_cnt, engine.file_cnt), (0, 4))
+		for name in ('55081.txt', '55081.txt+', 'IM55081.dcm'):
+			self.assertEqual(os.stat('copies2/55081/' + name).st_nlink, 1)
+			with open('copies2/55081/' + name, 'rb') as f:
+				self.assertEqual(f.read(), data)
+
+		# files of the same size are hashed once each, and only fully hashed when their partial hashes match
+		for i in range(20):
+			with open('tree/a/55081_%02d.dcm' % i, 'wb') as f:
+				f.write(os.urandom(1000))
+		with mock.patch('FileCopyUtil._partial_hash', wraps=FileCopyUtil._partial_hash) as partial_hash, \
+				mock.patch('FileCopyUtil._full_hash', wraps=FileCopyUtil._full_hash) as full_hash:
+			engine = FileCopyUtil._CopyEngine('copies3', 2, dedup=True)
+			engine.copy_match('55081', 'tree/a')
+			self.assertEqual(engine.finish(), 0)
+		self.assertEqual((engine.file_cnt, engine.linked_cnt), (21, 0))
+		self.assertEqual(partial_hash.call_count, 21)
+		self.assertEqual(full_hash.call_count, 0)
+
+	def test_extract_archives(self):
+		os.mkdir('tree')
+		with zipfile.ZipFile('tree/export.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+			zf.writestr('55081/IM0001.dcm', b'first')
+			zf.writestr('a/b/0055081.txt', b'nested')
+			zf.writestr('1234567/IM0001.dcm', b'other')
+		with open('tree/export.zip', 'rb') as f:
+			data = f.read()
+		central_dir = data.index(b'PK\x01\x02')
+		# an unsupported compression method, and an encrypted member, both in the first member
+		with open('tree/method.zip', 'wb') as f:
+			f.write(data[:8] + b'\x63\x00' + data[10:central_dir + 10] + b'\x63\x00' + data[central_dir + 12:])
+		with open('tree/encrypted.zip', 'wb') as f:
+			f.write(data[:6] + b'\x01' + data[7:central_dir + 8] + b'\x01' + data[central_dir + 9:])
+
+		engine = FileCopyUtil._CopyEngine('copies', 2, extract_archives=True)
+		for match in ('tree/export.zip', 'tree/method.zip', 'tree/encrypted.zip'):
+			engine.copy_match('55081', match)
+		self.assertEqual(engine.finish(), 0)
+
+		# only the matching members are extracted, with their folders
+		self.assertEqual(sorted(os.listdir('copies/55081/export')), ['55081', 'a'])
+		for path, content in (('55081/IM0001.dcm', b'first'), ('a/b/0055081.txt', b'nested')):
+			with open('copies/55081/export/' + path, 'rb') as f:
+				self.assertEqual(f.read(), content)
+
+		# archives whose members cannot be read are copied whole, without leaving empty folders
+		self.assertEqual(sorted(os.listdir('copies/55081')), ['export'])
+		for name in ('method.zip', 'encrypted.zip'):
+			self.assertEqual(FileCopyUtil._full_hash('copies/' + name), FileCopyUtil._full_hash('tree/' + name))
+
+		# as are archives that cannot be opened
+		with open('tree/broken.zip', 'wb') as f:
+			f.write(data[:central_dir])
+		engine = FileCopyUtil._CopyEngine('copies', 2, extract_archives=True)
+		with mock.patch('FileCopyUtil._matching_members', return_value=['55081/IM0001.dcm']):
+			engine.copy_match('55081', 'tree/broken.zip')
+		self.assertEqual(engine.finish(), 0)
+		self.assertTrue(os.path.exists('copies/broken.zip'))
+		self.assertFalse(os.path.exists('copies/55081/broken'))
+
+	def test_copy_file_data_fallback(self):
+		if FileCopyUtil.fcntl is None or not hasattr(os, 'copy_file_range') or not hasattr(os, 'sendfile'):
+			self.skipTest("the kernel copy mechanisms are not available")
+		data = os.urandom(3 * 1024 * 1024 + 123)
+		with open('src.bin', 'wb') as f:
+			f.write(data)
+		mb = 1024 * 1024
+		real_copy_file_range, real_sendfile = os.copy_file_range, os.sendfile
+
+		def failing_after(limit, err):
+			"""Let a mechanism copy limit bytes, then fail with err, like a copy that is not supported part of the way."""
+			left = [limit]
+			def take(count):
+				if not left[0]:
+					raise OSError(err, os.strerror(err))
+				count = min(count, left[0])
+				left[0] -= count
+				return count
+			return take
+
+		def copy(copy_file_range_limit, sendfile_limit, offset=0):
+			take_range = failing_after(copy_file_range_limit, errno.EXDEV)
+			take_send = failing_after(sendfile_limit, errno.ENOSYS)
+			def copy_file_range(src, dst, count, offset_src, offset_dst):
+				return real_copy_file_range(src, dst, take_range(count), offset_src, offset_dst)
+			def sendfile(out_fd, in_fd, offset, count):
+				return real_sendfile(out_fd, in_fd, offset, take_send(count))
+			with mock.patch.object(FileCopyUtil.fcntl, 'ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'Not supported')) as ioctl, \
+					mock.patch('os.copy_file_range', copy_file_range), mock.patch('os.sendfile', sendfile):
+				used = FileCopyUtil._copy_file_data('src.bin', 'dst.bin', offset)
+			self.assertEqual(ioctl.called, offset == 0)
+			with open('dst.bin', 'rb') as f:
+				self.assertEqual(f.read(), data)
+			return used
+
+		# each mechanism that stops part of the way hands over to the next one at the same offset
+		self.assertEqual(copy(mb, mb), [('copy_file_range', mb), ('sendfile', mb), ('buffered', mb + 123)])
+		self.assertEqual(copy(0, 2 * mb), [('sendfile', 2 * mb), ('buffered', mb + 123)])
+		self.assertEqual(copy(0, 0), [('buffered', len(data))])
+		self.assertEqual(copy(len(data), 0), [('copy_file_range', len(data))])
+
+		# a resumed copy keeps the first bytes of dst
+		with open('dst.bin', 'r+b') as f:
+			f.truncate(mb // 2)
+		self.assertEqual(copy(mb, 0, mb // 2), [('copy_file_range', mb), ('buffered', 2 * mb - mb // 2 + 123)])
+
+		# other errors are not hidden by the fallback
+		with mock.patch.object(FileCopyUtil.fcntl, 'ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'Not supported')), \
+				mock.patch('os.copy_file_range', side_effect=OSError(errno.EIO, 'I/O error')):
+			self.assertRaises(OSError, FileCopyUtil._copy_file_data, 'src.bin', 'dst2.bin')
+
+	def test_checksum_manifest(self):
+		os.makedirs('copies/55081/scans')
+		checksums = {}
+		for i, name in enumerate(['copies/55081/scans/IM0001.dcm', 'copies/55081/55081.txt', 'copies/export.zip']):
+			with open('src%d' % i, 'wb') as f:
+				f.write(os.urandom(3 * 1024 * 1024 + i))
+			hasher = FileCopyUtil.hashlib.new('sha256')
+			FileCopyUtil._copy_file_data('src%d' % i, name, hasher=hasher)
+			self.assertEqual(hasher.hexdigest(), FileCopyUtil._full_hash('src%d' % i, 'sha256').hex())
+			checksums[os.path.abspath(name)] = hasher.hexdigest()
+
+		FileCopyUtil._write_manifests(os.path.abspath('copies'), checksums, 'sha256')
+		self.assertTrue(os.path.exists('copies/55081/manifest.sha256'))
+		self.assertEqual(FileCopyUtil.verify_copies('copies'), [])
+		with open('copies/55081/scans/IM0001.dcm', 'r+b') as f:
+			first = f.read(1)
+			f.seek(0)
+			f.write(bytes([first[0] ^ 0xFF]))
+		os.remove('copies/export.zip')
+		self.assertEqual(sorted(FileCopyUtil.verify_copies('copies')),
+			sorted([os.path.join('copies', 'export.zip'), os.path.join('copies', '55081', 'scans/IM0001.dcm')]))
+
+	def test_search_and_copy_inside_root(self):
+		for path in ['tree/55081/IM0001.dcm', 'tree/a/0055081.txt']:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path, 'w') as f:
+				f.write(path)
+
+		# the copies of the first run are in the search root of the second run, and are not found again
+		for workers in (1, 4, 4):
+			paths = FileCopyUtil.search_and_copy(['55081'], '.', [], 'FileCopies', workers=workers)
+			self.assertEqual(sorted(paths['55081']), ['./tree/55081', './tree/a/0055081.txt'])
+		self.assertEqual(sorted(os.listdir('FileCopies/55081')), ['0055081.txt', '55081'])
+		self.assertEqual(os.listdir('FileCopies/55081/55081'), ['IM0001.dcm'])
+		with open('SearchHist.log') as f:
+			self.assertIn('./FileCopies', f.read().split('\n'))
+
+	def test_cli(self):
+		for path in ['tree/a/55081_scans/IM0001.dcm', 'tree/a/b/0055081.txt', 'tree/c/1234567.txt', 'tree/#recycle/55081.txt']:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path, 'w') as f:
+				f.write(path)
+		with open('mrns.txt', 'w') as f:
+			f.write('55081\n1234567, 7654321\n')
+		with open('none.txt', 'w') as f:
+			f.write('7654321\n')
+
+		self.assertEqual(FileCopyUtil.cli(['mrns.txt', 'tree', '--copy-dir', 'copies', '--checksum', 'sha256', '--verify']), 0)
+		self.assertEqual(sorted(os.listdir('copies/55081')), ['0055081.txt', '55081_scans', 'manifest.sha256'])
+		self.assertTrue(os.path.exists('copies/55081/55081_scans/IM0001.dcm'))
+		self.assertEqual(sorted(os.listdir('copies/1234567')), ['1234567.txt', 'manifest.sha256'])
+
+		# each search root is in the search history
+		self.assertEqual(FileCopyUtil.cli(['mrns.txt', 'tree/a', 'tree/c', '--no-copy']), 0)
+		with open('SearchHist.log') as f:
+			searched = f.read().split('\n')
+		self.assertIn('tree/a', searched)
+		self.assertIn('tree/c', searched)
+
+		# an absolute copy folder, and one that cannot be created
+		copy_dir = os.path.join(self.tmp_dir, 'abs', 'copies')
+		self.assertEqual(FileCopyUtil.cli(['mrns.txt', 'tree', '--copy-dir', copy_dir]), 0)
+		self.assertEqual(sorted(os.listdir(copy_dir)), ['1234567', '55081', 'CopyJournal.db'])
+		self.assertEqual(FileCopyUtil.cli(['mrns.txt', 'tree', '--copy-dir', 'mrns.txt/copies']), 4)
+
+		self.assertEqual(FileCopyUtil.cli(['none.txt', 'tree', '--copy-dir', 'copies']), 3)
+		for option in ('--copy-workers', '--search-workers'):
+			with mock.patch('sys.stderr'):
+				with self.assertRaises(SystemExit) as cm:
+					FileCopyUtil.cli(['mrns.txt', 'tree', option, '0'])
+			self.assertEqual(cm.exception.code, 2)
+		self.assertEqual(FileCopyUtil.cli(['missing.txt', 'tree']), 1)
+		self.assertEqual(FileCopyUtil.cli(['mrns.txt', 'missing_tree']), 1)
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file
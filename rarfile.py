@@ -70,6 +70,7 @@ from __future__ import division, print_function
 import sys
 import os
 import errno
+import mmap
 import struct
 
 from struct import pack, unpack, Struct
@@ -77,6 +78,8 @@ from binascii import crc32, hexlify
 from tempfile import mkstemp
 from subprocess import Popen, PIPE, STDOUT
 from io import RawIOBase
+from threading import Lock, Thread
+from collections import OrderedDict
 from hashlib import sha1, sha256
 from hmac import HMAC
 from datetime import datetime, timedelta, tzinfo
@@ -201,6 +204,10 @@ EXTRACT_ARGS = ('x', '-y', '-idq')
 #: args for testrar()
 TEST_ARGS = ('t', '-idq')
 
+#: archive name that makes the tool read the archive from stdin,
+#: None if it cannot (unrar needs a seekable file)
+STDIN_ARCHIVE = None
+
 #
 # Allow use of tool that is not compatible with unrar.
 #
@@ -217,6 +224,7 @@ ALT_OPEN_ARGS = ('-x', '--to-stdout', '-f')
 ALT_EXTRACT_ARGS = ('-x', '-f')
 ALT_TEST_ARGS = ('-t', '-f')
 ALT_CHECK_ARGS = ('--help',)
+ALT_STDIN_ARCHIVE = '-'
 
 #ALT_TOOL = 'unar'
 #ALT_OPEN_ARGS = ('-o', '-')
@@ -230,6 +238,23 @@ USE_EXTRACT_HACK = 1
 #: limit the filesize for tmp archive usage
 HACK_SIZE_LIMIT = 20 * 1024 * 1024
 
+#: directory for tmp archives given to the tool, None uses a RAM-backed
+#: one (/dev/shm) when it exists and has room, otherwise the system default
+TEMP_DIR = None
+
+#: block size for copying archive data to tmp archives and tool pipes
+COPY_BLOCK_SIZE = 1024 * 1024
+
+#: whether rar_namelist() parses memory-mapped volumes in place
+USE_MMAP = 1
+
+#: number of derived encryption keys kept in key_cache, shared by all archives
+KEY_CACHE_SIZE = 64
+
+#: number of threads hashing the Blake2SP lanes of large reads,
+#: 0 or 1 hashes them in the calling thread
+BLAKE2SP_THREADS = 8
+
 #: Separator for path name components.  RAR internally uses '\\'.
 #: Use '/' to be similar with zipfile.
 PATH_SEP = '/'
@@ -390,7 +415,6 @@ RAR5_ID = b"Rar!\x1a\x07\x01\x00"
 ZERO = b'\0'
 EMPTY = b''
 UTC = timezone(timedelta(0), 'UTC')
-BSIZE = 32 * 1024
 
 def _get_rar_version(xfile):
     """Check quickly whether file is rar archive.
@@ -581,37 +605,67 @@ class RarInfo(object):
 
     """
 
-    # zipfile-compatible fields
-    filename = None
-    file_size = None
-    compress_size = None
-    date_time = None
-    comment = None
-    CRC = None
-    volume = None
-    orig_filename = None
-
-    # optional extended time fields, datetime() objects.
-    mtime = None
-    ctime = None
-    atime = None
-
-    extract_version = None
-    mode = None
-    host_os = None
-    compress_type = None
-
-    # rar3-only fields
-    comment = None
-    arctime = None
-
-    # rar5-only fields
-    blake2sp_hash = None
-    file_redir = None
-
-    # internal fields
-    flags = 0
-    type = None
+    __slots__ = (
+        # zipfile-compatible fields
+        'filename', 'file_size', 'compress_size', 'comment', 'CRC',
+        'volume', 'volume_file', 'orig_filename',
+        'extract_version', 'mode', 'host_os', 'compress_type',
+        # rar5-only fields
+        'blake2sp_hash', 'file_redir',
+        # internal fields
+        'flags', 'type',
+        # timestamps, decoded from _raw_times on first access into _times,
+        # a list of (date_time, mtime, ctime, atime, arctime), or None if all are missing
+        '_raw_times', '_times',
+    )
+
+    def __init__(self):
+        self.filename = None
+        self.file_size = None
+        self.compress_size = None
+        self.comment = None
+        self.CRC = None
+        self.volume = None
+        self.volume_file = None
+        self.orig_filename = None
+        self.extract_version = None
+        self.mode = None
+        self.host_os = None
+        self.compress_type = None
+        self.blake2sp_hash = None
+        self.file_redir = None
+        self.flags = 0
+        self.type = None
+        self._raw_times = None
+        self._times = None
+
+    def _decode_times(self):
+        """Decode _raw_times into _times."""
+        self._raw_times = None
+
+    def _time_field(idx):
+        """Timestamp attribute, decoded lazily."""
+        def fget(self):
+            if self._raw_times is not None:
+                self._decode_times()
+            if self._times is None:
+                return None
+            return self._times[idx]
+
+        def fset(self, value):
+            if self._raw_times is not None:
+                self._decode_times()
+            if self._times is None:
+                self._times = [None] * 5
+            self._times[idx] = value
+        return property(fget, fset)
+
+    date_time = _time_field(0)
+    mtime = _time_field(1)
+    ctime = _time_field(2)
+    atime = _time_field(3)
+    arctime = _time_field(4)
+    del _time_field
 
     def isdir(self):
         """Returns True if entry is a directory.
@@ -831,6 +885,7 @@ class RarFile(object):
     def testrar(self):
         """Let 'unrar' test the archive.
         """
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(TEST_ARGS)
         add_password_arg(cmd, self._password)
         cmd.append('--')
@@ -869,6 +924,7 @@ class RarFile(object):
 
     # call unrar to extract a file
     def _extract(self, fnlist, path=None, psw=None):
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(EXTRACT_ARGS)
 
         # pasoword
@@ -908,6 +964,7 @@ class CommonParser(object):
     _expect_sig = None
     _parse_error = None
     _password = None
+    _hdr_ciph = (None, None)    # (key, decryptor)
     comment = None
 
     def __init__(self, rarfile, password, crc_check, charset, strict, info_cb):
@@ -1090,6 +1147,18 @@ class CommonParser(object):
             self._set_error('Broken header in RAR file')
             return None
 
+    def _header_decrypt(self, fd, key, iv):
+        """Decrypting reader for one header, reusing the AES decryptor
+        while the key stays the same.
+        """
+        if self._hdr_ciph[0] != key:
+            self._hdr_ciph = (key, AES_CBC_Decrypt(key, iv))
+        ciph = self._hdr_ciph[1]
+        # CBC state is the last ciphertext block, so decrypting
+        # the IV as a block restarts the chain from it
+        ciph.decrypt(iv)
+        return HeaderDecrypt(fd, key, iv, ciph)
+
     # given current vol name, construct next one
     def _next_volname(self, volfile):
         if is_filelike(volfile):
@@ -1149,28 +1218,30 @@ class CommonParser(object):
     def _open_hack_core(self, inf, psw, prefix, suffix):
 
         size = inf.compress_size + inf.header_size
-        rf = XFile(inf.volume_file, 0)
-        rf.seek(inf.header_offset)
 
-        tmpfd, tmpname = mkstemp(suffix='.rar')
-        tmpf = os.fdopen(tmpfd, "wb")
+        def write_archive(dst):
+            with XFile(inf.volume_file, 0) as rf:
+                rf.seek(inf.header_offset)
+                dst.write(prefix)
+                if copy_data(rf, dst, size) != size:
+                    raise BadRarFile('read failed: ' + inf.filename)
+                dst.write(suffix)
+
+        # feed the tool directly if it can read the archive from stdin
+        _ensure_unrar_tool()
+        if STDIN_ARCHIVE:
+            cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
+            add_password_arg(cmd, psw)
+            cmd.append(STDIN_ARCHIVE)
+            return PipeReader(self, inf, cmd, feed=write_archive)
+
+        tmpfd, tmpname = rar_mkstemp(size + len(prefix) + len(suffix))
+        tmpf = os.fdopen(tmpfd, "wb", 0)
 
         try:
-            tmpf.write(prefix)
-            while size > 0:
-                if size > BSIZE:
-                    buf = rf.read(BSIZE)
-                else:
-                    buf = rf.read(size)
-                if not buf:
-                    raise BadRarFile('read failed: ' + inf.filename)
-                tmpf.write(buf)
-                size -= len(buf)
-            tmpf.write(suffix)
+            write_archive(tmpf)
             tmpf.close()
-            rf.close()
         except:
-            rf.close()
             tmpf.close()
             os.unlink(tmpname)
             raise
@@ -1184,9 +1255,12 @@ class CommonParser(object):
 
     # extract using unrar
     def _open_unrar(self, rarfile, inf, psw=None, tmpfile=None, force_file=False):
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
         add_password_arg(cmd, psw)
-        cmd.append("--")
+        # bsdtar takes the archive name as -f value, it would read "--" as name
+        if UNRAR_TOOL != ALT_TOOL:
+            cmd.append("--")
         cmd.append(rarfile)
 
         # not giving filename avoids encoding related problems
@@ -1205,19 +1279,35 @@ class CommonParser(object):
 
 class Rar3Info(RarInfo):
     """RAR3 specific fields."""
-    extract_version = 15
-    salt = None
-    add_size = 0
-    header_crc = None
-    header_size = None
-    header_offset = None
-    data_offset = None
-    _md_class = None
-    _md_expect = None
-
-    # make sure some rar5 fields are always present
-    file_redir = None
-    blake2sp_hash = None
+    __slots__ = ('salt', 'add_size', 'header_crc', 'header_size', 'header_offset',
+                 'data_offset', '_md_class', '_md_expect')
+
+    def __init__(self):
+        super(Rar3Info, self).__init__()
+        self.extract_version = 15
+        self.salt = None
+        self.add_size = 0
+        self.header_crc = None
+        self.header_size = None
+        self.header_offset = None
+        self.data_offset = None
+        self._md_class = None
+        self._md_expect = None
+
+    def _decode_times(self):
+        # raw times are (dos time, extended time data or None)
+        dostime, xdata = self._raw_times
+        self._raw_times = None
+        date_time = parse_dos_time(dostime)
+        if xdata is None:
+            self._times = [date_time, None, None, None, None]
+            return
+        mtime = to_datetime(date_time)
+        xmtime, ctime, atime, arctime = _decode_ext_time(xdata, mtime)
+        if xmtime:
+            mtime = xmtime
+            date_time = mtime.timetuple()[:6]
+        self._times = [date_time, mtime, ctime, atime, arctime]
 
     def _must_disable_hack(self):
         if self.type == RAR_BLOCK_FILE:
@@ -1235,18 +1325,14 @@ class RAR3Parser(CommonParser):
     """Parse RAR3 file format.
     """
     _expect_sig = RAR_ID
-    _last_aes_key = (None, None, None)   # (salt, key, iv)
 
     def _decrypt_header(self, fd):
         if not _have_crypto:
             raise NoCrypto('Cannot parse encrypted headers - no crypto')
         salt = fd.read(8)
-        if self._last_aes_key[0] == salt:
-            key, iv = self._last_aes_key[1:]
-        else:
-            key, iv = rar3_s2k(self._password, salt)
-            self._last_aes_key = (salt, key, iv)
-        return HeaderDecrypt(fd, key, iv)
+        psw = self._password
+        key, iv = key_cache.get(('rar3', psw, salt), lambda: rar3_s2k(psw, salt))
+        return self._header_decrypt(fd, key, iv)
 
     # common header
     def _parse_block_header(self, fd):
@@ -1335,8 +1421,7 @@ class RAR3Parser(CommonParser):
         h.file_size = fld[1]
         h.host_os = fld[2]
         h.CRC = fld[3]
-        h.date_time = parse_dos_time(fld[4])
-        h.mtime = to_datetime(h.date_time)
+        dostime = fld[4]
         h.extract_version = fld[5]
         h.compress_type = fld[6]
         name_size = fld[7]
@@ -1375,11 +1460,15 @@ class RAR3Parser(CommonParser):
         else:
             h.salt = None
 
-        # optional extended time stamps
+        # optional extended time stamps, decoded on first access
+        xdata = None
         if h.flags & RAR_FILE_EXTTIME:
-            pos = _parse_ext_time(h, hdata, pos)
-        else:
-            h.mtime = h.atime = h.ctime = h.arctime = None
+            xpos = pos
+            pos = _skip_ext_time(hdata, pos)
+            if pos > len(hdata):
+                raise BadRarFile('cannot load extended time')
+            xdata = hdata[xpos:pos]
+        h._raw_times = (dostime, xdata)
 
         return pos
 
@@ -1431,12 +1520,7 @@ class RAR3Parser(CommonParser):
         return self._decode_comment(cmt)
 
     def _decode(self, val):
-        for c in TRY_ENCODINGS:
-            try:
-                return val.decode(c)
-            except UnicodeError:
-                pass
-        return val.decode(self._charset, 'replace')
+        return _decode_rar3(val, self._charset)
 
     def _decode_comment(self, val):
         return self._decode(val)
@@ -1489,38 +1573,73 @@ class RAR3Parser(CommonParser):
 class Rar5Info(RarInfo):
     """Shared fields for RAR5 records.
     """
-    extract_version = 50
-    header_crc = None
-    header_size = None
-    header_offset = None
-    data_offset = None
-
-    # type=all
-    block_type = None
-    block_flags = None
-    add_size = 0
-    block_extra_size = 0
-
-    # type=MAIN
-    volume_number = None
-    _md_class = None
-    _md_expect = None
+    __slots__ = ('header_crc', 'header_size', 'header_offset', 'data_offset',
+                 'block_type', 'block_flags', 'add_size', 'block_extra_size',
+                 'volume_number', '_md_class', '_md_expect')
+
+    def __init__(self):
+        super(Rar5Info, self).__init__()
+        self.extract_version = 50
+        self.header_crc = None
+        self.header_size = None
+        self.header_offset = None
+        self.data_offset = None
+
+        # type=all
+        self.block_type = None
+        self.block_flags = None
+        self.add_size = 0
+        self.block_extra_size = 0
+
+        # type=MAIN
+        self.volume_number = None
+        self._md_class = None
+        self._md_expect = None
+
+    def _decode_times(self):
+        # raw times are (unix mtime or None, time extra record or None)
+        raw_mtime, xtime = self._raw_times
+        self._raw_times = None
+        mtime = ctime = atime = None
+        if raw_mtime is not None:
+            mtime = _unix_to_datetime(raw_mtime)
+        if xtime is not None:
+            tflags, raw_mtime, raw_ctime, raw_atime = xtime
+            conv = _windows_to_datetime
+            if tflags & RAR5_XTIME_UNIXTIME:
+                conv = _unix_to_datetime
+            if raw_mtime is not None:
+                mtime = conv(raw_mtime)
+            if raw_ctime is not None:
+                ctime = conv(raw_ctime)
+            if raw_atime is not None:
+                atime = conv(raw_atime)
+        date_time = None
+        if mtime:
+            date_time = mtime.timetuple()[:6]
+        self._times = [date_time, mtime, ctime, atime, None]
 
     def _must_disable_hack(self):
         return False
 
 
+_NO_FILE_ENCRYPTION = (0, 0, 0, EMPTY, EMPTY, EMPTY)
+
 class Rar5BaseFile(Rar5Info):
     """Shared sturct for file & service record.
     """
-    type = -1
-    file_flags = None
-    file_encryption = (0, 0, 0, EMPTY, EMPTY, EMPTY)
-    file_compress_flags = None
-    file_redir = None
-    file_owner = None
-    file_version = None
-    blake2sp_hash = None
+    __slots__ = ('file_flags', 'file_encryption', 'file_compress_flags',
+                 'file_host_os', 'file_owner', 'file_version')
+
+    def __init__(self):
+        super(Rar5BaseFile, self).__init__()
+        self.type = -1
+        self.file_flags = None
+        self.file_encryption = _NO_FILE_ENCRYPTION
+        self.file_compress_flags = None
+        self.file_host_os = None
+        self.file_owner = None
+        self.file_version = None
 
     def _must_disable_hack(self):
         if self.flags & RAR_FILE_PASSWORD:
@@ -1537,21 +1656,33 @@ class Rar5BaseFile(Rar5Info):
 class Rar5FileInfo(Rar5BaseFile):
     """RAR5 file record.
     """
-    type = RAR_BLOCK_FILE
+    __slots__ = ()
+
+    def __init__(self):
+        super(Rar5FileInfo, self).__init__()
+        self.type = RAR_BLOCK_FILE
 
 
 class Rar5ServiceInfo(Rar5BaseFile):
     """RAR5 service record.
     """
-    type = RAR_BLOCK_SUB
+    __slots__ = ()
+
+    def __init__(self):
+        super(Rar5ServiceInfo, self).__init__()
+        self.type = RAR_BLOCK_SUB
 
 
 class Rar5MainInfo(Rar5Info):
     """RAR5 archive main record.
     """
-    type = RAR_BLOCK_MAIN
-    main_flags = None
-    main_volume_number = None
+    __slots__ = ('main_flags', 'main_volume_number')
+
+    def __init__(self):
+        super(Rar5MainInfo, self).__init__()
+        self.type = RAR_BLOCK_MAIN
+        self.main_flags = None
+        self.main_volume_number = None
 
     def _must_disable_hack(self):
         if self.main_flags & RAR5_MAIN_FLAG_SOLID:
@@ -1562,12 +1693,17 @@ class Rar5MainInfo(Rar5Info):
 class Rar5EncryptionInfo(Rar5Info):
     """RAR5 archive header encryption record.
     """
-    type = RAR5_BLOCK_ENCRYPTION
-    encryption_algo = None
-    encryption_flags = None
-    encryption_kdf_count = None
-    encryption_salt = None
-    encryption_check_value = None
+    __slots__ = ('encryption_algo', 'encryption_flags', 'encryption_kdf_count',
+                 'encryption_salt', 'encryption_check_value')
+
+    def __init__(self):
+        super(Rar5EncryptionInfo, self).__init__()
+        self.type = RAR5_BLOCK_ENCRYPTION
+        self.encryption_algo = None
+        self.encryption_flags = None
+        self.encryption_kdf_count = None
+        self.encryption_salt = None
+        self.encryption_check_value = None
 
     def needs_password(self):
         return True
@@ -1576,8 +1712,12 @@ class Rar5EncryptionInfo(Rar5Info):
 class Rar5EndArcInfo(Rar5Info):
     """RAR5 end of archive record.
     """
-    type = RAR_BLOCK_ENDARC
-    endarc_flags = None
+    __slots__ = ('endarc_flags',)
+
+    def __init__(self):
+        super(Rar5EndArcInfo, self).__init__()
+        self.type = RAR_BLOCK_ENDARC
+        self.endarc_flags = None
 
 
 class RAR5Parser(CommonParser):
@@ -1587,19 +1727,14 @@ class RAR5Parser(CommonParser):
     _hdrenc_main = None
 
     # AES encrypted headers
-    _last_aes256_key = (-1, None, None)   # (kdf_count, salt, key)
-
     def _gen_key(self, kdf_count, salt):
-        if self._last_aes256_key[:2] == (kdf_count, salt):
-            return self._last_aes256_key[2]
         if kdf_count > 24:
             raise BadRarFile('Too large kdf_count')
         psw = self._password
         if isinstance(psw, unicode):
             psw = psw.encode('utf8')
-        key = pbkdf2_sha256(psw, salt, 1 << kdf_count)
-        self._last_aes256_key = (kdf_count, salt, key)
-        return key
+        return key_cache.get(('rar5', psw, salt, kdf_count),
+                             lambda: pbkdf2_sha256(psw, salt, 1 << kdf_count))
 
     def _decrypt_header(self, fd):
         if not _have_crypto:
@@ -1607,7 +1742,7 @@ class RAR5Parser(CommonParser):
         h = self._hdrenc_main
         key = self._gen_key(h.encryption_kdf_count, h.encryption_salt)
         iv = fd.read(16)
-        return HeaderDecrypt(fd, key, iv)
+        return self._header_decrypt(fd, key, iv)
 
     # common header
     def _parse_block_header(self, fd):
@@ -1704,8 +1839,8 @@ class RAR5Parser(CommonParser):
         h.mode, pos = load_vint(hdata, pos)
 
         if h.file_flags & RAR5_FILE_FLAG_HAS_MTIME:
-            h.mtime, pos = load_unixtime(hdata, pos)
-            h.date_time = h.mtime.timetuple()[:6]
+            mtime, pos = load_le32(hdata, pos)
+            h._raw_times = (mtime, None)
         if h.file_flags & RAR5_FILE_FLAG_HAS_CRC32:
             h.CRC, pos = load_le32(hdata, pos)
             h._md_class = CRC32Context
@@ -1782,16 +1917,18 @@ class RAR5Parser(CommonParser):
     # extra block for file time record
     def _parse_file_xtime(self, h, xdata, pos):
         tflags, pos = load_vint(xdata, pos)
-        ldr = load_windowstime
+        ldr = load_le64
         if tflags & RAR5_XTIME_UNIXTIME:
-            ldr = load_unixtime
+            ldr = load_le32
+        mtime = ctime = atime = None
         if tflags & RAR5_XTIME_HAS_MTIME:
-            h.mtime, pos = ldr(xdata, pos)
-            h.date_time = h.mtime.timetuple()[:6]
+            mtime, pos = ldr(xdata, pos)
         if tflags & RAR5_XTIME_HAS_CTIME:
-            h.ctime, pos = ldr(xdata, pos)
+            ctime, pos = ldr(xdata, pos)
         if tflags & RAR5_XTIME_HAS_ATIME:
-            h.atime, pos = ldr(xdata, pos)
+            atime, pos = ldr(xdata, pos)
+        raw = h._raw_times or (None, None)
+        h._raw_times = (raw[0], (tflags, mtime, ctime, atime))
 
     # just remember encryption info
     def _parse_file_encryption(self, h, xdata, pos):
@@ -1873,7 +2010,7 @@ class RAR5Parser(CommonParser):
             if algo != RAR5_XENC_CIPHER_AES256:
                 return None
             key = self._gen_key(kdf_count, salt)
-            f = HeaderDecrypt(fd, key, iv)
+            f = self._header_decrypt(fd, key, iv)
             cmt = f.read(item.file_size)
         else:
             # archive comment
@@ -1892,6 +2029,259 @@ class RAR5Parser(CommonParser):
         endarc_hdr = S_LONG.pack(rar_crc32(endarc_hdr)) + endarc_hdr
         return self._open_hack_core(inf, psw, RAR5_ID + main_hdr, endarc_hdr)
 
+#
+# Names-only parsing
+#
+
+def rar_namelist(rarfile, charset=None):
+    """Return the names of the files in an archive, the same as RarFile(rarfile).namelist(),
+    but only walk the block headers and decode the file names, without building RarInfo
+    records or reading comments.  Later volumes are followed like in RarFile.
+
+    With USE_MMAP, each volume is memory-mapped and headers are parsed in place.
+    File objects, and volumes that cannot be mapped, are listed with RarFile.
+
+    Archives with encrypted headers list no files, like RarFile without a password.
+    """
+    ver = _get_rar_version(rarfile)
+    if ver == 3:
+        expect_sig, parse_block = RAR_ID, _parse_rar3_name_block
+    elif ver == 5:
+        expect_sig, parse_block = RAR5_ID, _parse_rar5_name_block
+    else:
+        raise BadRarFile("Not a RAR file")
+    charset = charset or DEFAULT_CHARSET
+
+    if not USE_MMAP or is_filelike(rarfile):
+        return RarFile(rarfile, charset=charset).namelist()
+    try:
+        buf = _map_volume(rarfile)
+    except (ValueError, EnvironmentError):
+        return RarFile(rarfile, charset=charset).namelist()
+
+    names = []
+    main_flags = None
+    volume = 0
+    more_vols = False
+    endarc = False
+    volfile = rarfile
+    pos = len(expect_sig)
+    try:
+        while 1:
+            h = None
+            if not endarc:
+                try:
+                    h = parse_block(buf, pos, charset)
+                except struct.error:
+                    h = None
+            if not h:
+                if not more_vols:
+                    break
+                volume += 1
+                buf.close()
+                try:
+                    if main_flags & RAR_MAIN_NEWNUMBERING:
+                        volfile = _next_newvol(volfile)
+                    else:
+                        volfile = _next_oldvol(volfile)
+                    buf = _map_volume(volfile)
+                except (ValueError, EnvironmentError):
+                    break
+                if buf[:len(expect_sig)] != expect_sig:
+                    break
+                pos = len(expect_sig)
+                more_vols = False
+                endarc = False
+                continue
+
+            block_type, flags, pos, name = h
+            if block_type == RAR_BLOCK_MAIN and main_flags is None:
+                main_flags = flags
+                if flags & RAR_MAIN_NEWNUMBERING and (flags & RAR_MAIN_FIRSTVOLUME) == 0:
+                    raise NeedFirstVolume("Need to start from first volume")
+                if flags & RAR_MAIN_PASSWORD:
+                    break
+            elif block_type == RAR5_BLOCK_ENCRYPTION:
+                break
+            elif block_type == RAR_BLOCK_ENDARC:
+                more_vols = (flags & RAR_ENDARC_NEXT_VOLUME) > 0
+                endarc = True
+            elif block_type == RAR_BLOCK_FILE:
+                if flags & RAR_FILE_SPLIT_AFTER:
+                    more_vols = True
+                if flags & RAR_FILE_SPLIT_BEFORE:
+                    if volume == 0:
+                        raise NeedFirstVolume("Need to start from first volume")
+                else:
+                    names.append(name)
+    finally:
+        buf.close()
+    return names
+
+def _map_volume(volfile):
+    """Return read-only memory map of whole volume."""
+    with open(volfile, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _parse_rar3_name_block(buf, pos, charset):
+    """Parse the RAR3 block header at pos, decoding only the name of file blocks.
+    Returns (type, flags, next_pos, name), or None at the end or on a bad header.
+    """
+    header_crc, block_type, flags, header_size = S_BLK_HDR.unpack_from(buf, pos)
+    data_offset = pos + header_size
+    if header_size < S_BLK_HDR.size or data_offset > len(buf):
+        return None
+    hdata = buf[pos:data_offset]
+
+    pos = S_BLK_HDR.size
+    add_size = 0
+    if flags & RAR_LONG_BLOCK:
+        add_size, pos = load_le32(hdata, pos)
+
+    name = None
+    if block_type == RAR_BLOCK_MARK:
+        return block_type, flags, data_offset + add_size, name
+    elif block_type == RAR_BLOCK_MAIN:
+        crc_pos = pos + 6
+        if flags & RAR_MAIN_ENCRYPTVER:
+            crc_pos += 1
+    elif block_type == RAR_BLOCK_FILE or block_type == RAR_BLOCK_SUB:
+        pos -= 4
+        fld = S_FILE_HDR.unpack_from(hdata, pos)
+        pos += S_FILE_HDR.size
+        if flags & RAR_FILE_LARGE:
+            h1, pos = load_le32(hdata, pos)
+            ___h2, pos = load_le32(hdata, pos)
+            add_size = fld[0] | (h1 << 32)
+        name, pos = load_bytes(hdata, fld[7], pos)
+        if flags & RAR_FILE_SALT:
+            pos += 8
+        if flags & RAR_FILE_EXTTIME:
+            pos = _skip_ext_time(hdata, pos)
+        if pos > len(hdata):
+            raise BadRarFile('cannot load file header')
+
+        if block_type == RAR_BLOCK_FILE:
+            crc_pos = pos
+            name = _decode_rar3_filename(name, flags, charset)
+        else:
+            crc_pos = header_size
+    elif block_type == RAR_BLOCK_OLD_AUTH:
+        crc_pos = pos + 8
+    elif block_type == RAR_BLOCK_OLD_EXTRA:
+        crc_pos = pos + 7
+    else:
+        crc_pos = header_size
+
+    if block_type == RAR_BLOCK_OLD_SUB:
+        crcdat = hdata[2:] + buf[data_offset:data_offset + add_size]
+    else:
+        crcdat = memoryview(hdata)[2:crc_pos]
+    if rar_crc32(crcdat) & 0xFFFF != header_crc:
+        return None
+    return block_type, flags, data_offset + add_size, name
+
+def _parse_rar5_name_block(buf, pos, charset):
+    """Parse the RAR5 block header at pos, decoding only the name of file blocks.
+    Returns the same as _parse_rar3_name_block, with RAR5 flags mapped to the RAR3 ones.
+    The header is checked against its CRC first and then read straight out of buf.
+    """
+    header_crc, hpos = load_le32(buf, pos)
+    hdrlen, hpos = load_vint(buf, hpos)
+    if hdrlen > 2 * 1024 * 1024:
+        return None
+    data_offset = hpos + hdrlen
+    if data_offset > len(buf):
+        return None
+    if rar_crc32(buf[pos + 4:data_offset]) != header_crc:
+        return None
+    pos = hpos
+
+    block_type, pos = load_vint(buf, pos)
+    block_flags, pos = load_vint(buf, pos)
+    if block_flags & RAR5_BLOCK_FLAG_EXTRA_DATA:
+        ___extra_size, pos = load_vint(buf, pos)
+    add_size = 0
+    if block_flags & RAR5_BLOCK_FLAG_DATA_AREA:
+        add_size, pos = load_vint(buf, pos)
+
+    flags = 0
+    name = None
+    if block_type == RAR5_BLOCK_MAIN:
+        main_flags, pos = load_vint(buf, pos)
+        flags = RAR_MAIN_NEWNUMBERING
+        if not main_flags & RAR5_MAIN_FLAG_HAS_VOLNR:
+            flags |= RAR_MAIN_FIRSTVOLUME
+        block_type = RAR_BLOCK_MAIN
+    elif block_type == RAR5_BLOCK_FILE or block_type == RAR5_BLOCK_SERVICE:
+        file_flags, pos = load_vint(buf, pos)
+        ___file_size, pos = load_vint(buf, pos)
+        ___mode, pos = load_vint(buf, pos)
+        if file_flags & RAR5_FILE_FLAG_HAS_MTIME:
+            pos += 4
+        if file_flags & RAR5_FILE_FLAG_HAS_CRC32:
+            pos += 4
+        ___compress_flags, pos = load_vint(buf, pos)
+        ___host_os, pos = load_vint(buf, pos)
+        name_size, pos = load_vint(buf, pos)
+        if pos + name_size > data_offset:
+            raise BadRarFile('cannot load bytes')
+        name = buf[pos:pos + name_size]
+
+        if block_flags & RAR5_BLOCK_FLAG_SPLIT_BEFORE:
+            flags |= RAR_FILE_SPLIT_BEFORE
+        if block_flags & RAR5_BLOCK_FLAG_SPLIT_AFTER:
+            flags |= RAR_FILE_SPLIT_AFTER
+        if block_type == RAR5_BLOCK_FILE:
+            name = name.decode('utf8', 'replace')
+            block_type = RAR_BLOCK_FILE
+        else:
+            block_type = RAR_BLOCK_SUB
+    elif block_type == RAR5_BLOCK_ENDARC:
+        endarc_flags, pos = load_vint(buf, pos)
+        if endarc_flags & RAR5_ENDARC_FLAG_NEXT_VOL:
+            flags |= RAR_ENDARC_NEXT_VOLUME
+        block_type = RAR_BLOCK_ENDARC
+    elif block_type != RAR5_BLOCK_ENCRYPTION:
+        return None
+    return block_type, flags, data_offset + add_size, name
+
+def _skip_ext_time(data, pos):
+    """Skip RAR3 extended time fields, see _parse_ext_time."""
+    flags = 0
+    if pos + 2 <= len(data):
+        flags = S_SHORT.unpack_from(data, pos)[0]
+        pos += 2
+    for shift in (3 * 4, 2 * 4, 1 * 4, 0):
+        flag = flags >> shift
+        if flag & 8:
+            if shift != 3 * 4:
+                pos += 4    # ctime, atime and arctime have their own dos time
+            pos += flag & 3
+    return pos
+
+def _decode_rar3_filename(name, flags, charset):
+    """Decode RAR3 file name, as in RAR3Parser._parse_file_header."""
+    if flags & RAR_FILE_UNICODE:
+        nul = name.find(ZERO)
+        u = UnicodeFilename(name[:nul], name[nul + 1:])
+        filename = u.decode()
+        if u.failed:
+            filename = _decode_rar3(name[:nul], charset)
+    else:
+        filename = _decode_rar3(name, charset)
+    if PATH_SEP != '\\':
+        filename = filename.replace('\\', PATH_SEP)
+    return filename
+
+def _decode_rar3(val, charset):
+    for c in TRY_ENCODINGS:
+        try:
+            return val.decode(c)
+        except UnicodeError:
+            pass
+    return val.decode(charset, 'replace')
+
 ##
 ## Utility classes
 ##
@@ -2144,17 +2534,45 @@ class RarExtFile(RawIOBase):
 class PipeReader(RarExtFile):
     """Read data from pipe, handle tempfile cleanup."""
 
-    def __init__(self, rf, inf, cmd, tempfile=None):
+    def __init__(self, rf, inf, cmd, tempfile=None, feed=None):
         self._cmd = cmd
         self._proc = None
         self._tempfile = tempfile
+        self._feed = feed
+        self._feeder = None
+        self._feed_error = None
         super(PipeReader, self).__init__(rf, inf)
 
+    def _run_feed(self, stdin):
+        """Write archive to tool stdin, in a thread."""
+        try:
+            self._feed(stdin)
+        except Exception as ex:
+            # a closed pipe only means that the tool exited or the reader
+            # was closed, other errors are raised by the reader
+            if not isinstance(ex, ValueError) and getattr(ex, 'errno', None) != errno.EPIPE:
+                self._feed_error = ex
+        finally:
+            try:
+                stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def _check_feed(self):
+        """Raise the error that stopped the feeder, once."""
+        ex, self._feed_error = self._feed_error, None
+        if ex is not None:
+            raise ex
+
     def _close_proc(self):
         if not self._proc:
             return
         if self._proc.stdout:
             self._proc.stdout.close()
+        if self._feeder:
+            # tool gets EPIPE on output and stops reading, which stops the feeder
+            self._feeder.join()
+            self._feeder = None
         if self._proc.stdin:
             self._proc.stdin.close()
         if self._proc.stderr:
@@ -2174,8 +2592,13 @@ class PipeReader(RarExtFile):
         self._proc = custom_popen(self._cmd)
         self._fd = self._proc.stdout
 
-        # avoid situation where unrar waits on stdin
-        if self._proc.stdin:
+        if self._feed:
+            self._feed_error = None
+            self._feeder = Thread(target=self._run_feed, args=(self._proc.stdin,))
+            self._feeder.daemon = True
+            self._feeder.start()
+        elif self._proc.stdin:
+            # avoid situation where unrar waits on stdin
             self._proc.stdin.close()
 
     def _read(self, cnt):
@@ -2183,7 +2606,11 @@ class PipeReader(RarExtFile):
 
         # normal read is usually enough
         data = self._fd.read(cnt)
-        if len(data) == cnt or not data:
+        if len(data) == cnt:
+            return data
+        if not data:
+            # tool stopped, maybe because the archive could not be fed to it
+            self._check_feed()
             return data
 
         # short read, try looping
@@ -2192,6 +2619,7 @@ class PipeReader(RarExtFile):
         while cnt > 0:
             data = self._fd.read(cnt)
             if not data:
+                self._check_feed()
                 break
             cnt -= len(data)
             buf.append(data)
@@ -2210,6 +2638,8 @@ class PipeReader(RarExtFile):
                 pass
             self._tempfile = None
 
+        self._check_feed()
+
     def readinto(self, buf):
         """Zero-copy read directly into buffer."""
         cnt = len(buf)
@@ -2353,10 +2783,11 @@ class DirectReader(RarExtFile):
 
 class HeaderDecrypt(object):
     """File-like object that decrypts from another file"""
-    def __init__(self, f, key, iv):
+    def __init__(self, f, key, iv, ciph=None):
         self.f = f
-        self.ciph = AES_CBC_Decrypt(key, iv)
+        self.ciph = ciph or AES_CBC_Decrypt(key, iv)
         self.buf = EMPTY
+        self.bufpos = 0
 
     def tell(self):
         """Current file pos - works only on block boundaries."""
@@ -2368,30 +2799,23 @@ class HeaderDecrypt(object):
             raise BadRarFile('Bad count to header decrypt - wrong password?')
 
         # consume old data
-        if cnt <= len(self.buf):
-            res = self.buf[:cnt]
-            self.buf = self.buf[cnt:]
-            return res
-        res = self.buf
-        self.buf = EMPTY
-        cnt -= len(res)
-
-        # decrypt new data
+        pos = self.bufpos
+        avail = len(self.buf) - pos
+        if cnt <= avail:
+            self.bufpos = pos + cnt
+            return self.buf[pos:pos + cnt]
+        res = self.buf[pos:]
+        cnt -= avail
+
+        # decrypt all blocks needed for the rest with one call,
+        # never reading past the block that holds the last byte
         blklen = 16
-        while cnt > 0:
-            enc = self.f.read(blklen)
-            if len(enc) < blklen:
-                break
-            dec = self.ciph.decrypt(enc)
-            if cnt >= len(dec):
-                res += dec
-                cnt -= len(dec)
-            else:
-                res += dec[:cnt]
-                self.buf = dec[cnt:]
-                cnt = 0
-
-        return res
+        enc = self.f.read((cnt + blklen - 1) // blklen * blklen)
+        enc = enc[:len(enc) - len(enc) % blklen]
+        dec = self.ciph.decrypt(enc) if enc else EMPTY
+        self.buf = dec
+        self.bufpos = min(cnt, len(dec))
+        return res + dec[:cnt]
 
 
 # handle (filename|filelike) object
@@ -2425,6 +2849,10 @@ class XFile(object):
         """Read into buffer."""
         return self._fd.readinto(dst)
 
+    def fileno(self):
+        """Return file descriptor."""
+        return self._fd.fileno()
+
     def close(self):
         """Close file object."""
         if self._need_close:
@@ -2437,6 +2865,56 @@ class XFile(object):
         self.close()
 
 
+class KeyCache(object):
+    """Thread-safe LRU cache of derived encryption keys.
+
+    Keys are looked up by (format, password, salt, kdf parameters),
+    with the password replaced by its SHA-256 digest, so archives
+    sharing a password only pay for key derivation once.
+    Holds at most KEY_CACHE_SIZE keys.
+    """
+
+    def __init__(self):
+        self._keys = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, params, derive):
+        """Return cached key for params, calling derive() on a miss."""
+        psw = params[1]
+        if isinstance(psw, unicode):
+            psw = psw.encode('utf8')
+        ckey = (params[0], sha256(psw or EMPTY).digest()) + tuple(params[2:])
+        with self._lock:
+            if ckey in self._keys:
+                self.hits += 1
+                key = self._keys.pop(ckey)
+                self._keys[ckey] = key
+                return key
+            self.misses += 1
+
+        # derive outside the lock, it can take seconds
+        key = derive()
+        with self._lock:
+            self._keys[ckey] = key
+            while len(self._keys) > max(KEY_CACHE_SIZE, 0):
+                self._keys.popitem(last=False)
+        return key
+
+    def clear(self):
+        """Drop all keys and reset the counters."""
+        with self._lock:
+            self._keys.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+#: derived keys shared by all RarFile instances
+key_cache = KeyCache()
+
+
 class NoHashContext(object):
     """No-op hash function."""
     def __init__(self, data=None):
@@ -2500,6 +2978,35 @@ class Blake2SP(object):
         self._thread[self._cur].update(blk)
         self._cur = (self._cur + 1) % self.parallelism
 
+    def _add_rounds(self, view):
+        """Hash whole rounds of one block per lane.
+
+        Each lane's blocks are gathered into one buffer with strided
+        copies of 8-byte words, and large lanes are hashed in parallel
+        (hashlib releases the GIL while hashing).
+        """
+        words = view.cast('Q')
+        bw = self.block_size // 8
+        step = bw * self.parallelism
+        nrounds = len(words) // step
+        lanes = []
+        for i in range(self.parallelism):
+            lane = bytearray(nrounds * self.block_size)
+            dst = memoryview(lane).cast('Q')
+            src = ((i - self._cur) % self.parallelism) * bw
+            for w in range(bw):
+                dst[w::bw] = words[src + w::step]
+            lanes.append(lane)
+
+        if BLAKE2SP_THREADS > 1 and nrounds >= 1024:
+            pool = _get_hash_pool()
+            jobs = [pool.submit(t.update, lane) for t, lane in zip(self._thread, lanes)]
+            for job in jobs:
+                job.result()
+        else:
+            for t, lane in zip(self._thread, lanes):
+                t.update(lane)
+
     def update(self, data):
         """Hash data.
         """
@@ -2512,6 +3019,11 @@ class Blake2SP(object):
                 return
             self._add_block(self._buf + view[:need].tobytes())
             view = view[need:]
+        rlen = bs * self.parallelism
+        if len(view) >= rlen and view.itemsize == 1 and hasattr(view, 'cast'):
+            n = len(view) - len(view) % rlen
+            self._add_rounds(view[:n])
+            view = view[n:]
         while len(view) >= bs:
             self._add_block(view[:bs])
             view = view[bs:]
@@ -2535,6 +3047,19 @@ class Blake2SP(object):
         return tohex(self.digest())
 
 
+_hash_pool = None
+_hash_pool_lock = Lock()
+
+def _get_hash_pool():
+    """Return thread pool for Blake2SP lanes, created on first use."""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _hash_pool = ThreadPoolExecutor(max_workers=BLAKE2SP_THREADS)
+    return _hash_pool
+
+
 class Rar3Sha1(object):
     """Bug-compat for SHA1
     """
@@ -2572,12 +3097,16 @@ class Rar3Sha1(object):
         """Return final state as hex string."""
         return self._md.hexdigest()
 
+    # word indexes for SHA1 message expansion, t = 16..79 in 16-word ring
+    _EXPAND = tuple(((t - 3) & 15, (t - 8) & 15, (t - 14) & 15, (t - 16) & 15, t & 15)
+                    for t in range(16, 80))
+
     def _corrupt(self, data, dpos):
         """Corruption from SHA1 core."""
         ws = list(self._BLK_BE.unpack_from(data, dpos))
-        for t in range(16, 80):
-            tmp = ws[(t - 3) & 15] ^ ws[(t - 8) & 15] ^ ws[(t - 14) & 15] ^ ws[(t - 16) & 15]
-            ws[t & 15] = ((tmp << 1) | (tmp >> (32 - 1))) & 0xFFFFFFFF
+        for w3, w8, w14, w16, t in self._EXPAND:
+            tmp = ws[w3] ^ ws[w8] ^ ws[w14] ^ ws[w16]
+            ws[t] = ((tmp << 1) | (tmp >> 31)) & 0xFFFFFFFF
         self._BLK_LE.pack_into(data, dpos, *ws)
 
 
@@ -2595,6 +3124,11 @@ S_COMMENT_HDR = Struct('<HBBH')
 
 def load_vint(buf, pos):
     """Load variable-size int."""
+    # most values fit in one byte
+    if pos < len(buf):
+        b = _byte_code(buf[pos])
+        if b < 0x80:
+            return b, pos + 1
     limit = min(pos + 11, len(buf))
     res = ofs = 0
     while pos < limit:
@@ -2620,6 +3154,12 @@ def load_le32(buf, pos):
         raise BadRarFile('cannot load le32')
     return S_LONG.unpack_from(buf, pos)[0], pos + 4
 
+def load_le64(buf, pos):
+    """Load little-endian 64-bit integer"""
+    lo, pos = load_le32(buf, pos)
+    hi, pos = load_le32(buf, pos)
+    return (hi << 32) | lo, pos
+
 def load_bytes(buf, num, pos):
     """Load sequence of bytes"""
     end = pos + num
@@ -2641,19 +3181,24 @@ def load_dostime(buf, pos):
 def load_unixtime(buf, pos):
     """Load LE32 unix timestamp"""
     secs, pos = load_le32(buf, pos)
-    dt = datetime.fromtimestamp(secs, UTC)
-    return dt, pos
+    return _unix_to_datetime(secs), pos
 
 def load_windowstime(buf, pos):
     """Load LE64 windows timestamp"""
+    val, pos = load_le64(buf, pos)
+    return _windows_to_datetime(val), pos
+
+def _unix_to_datetime(secs):
+    """Convert unix timestamp to UTC datetime"""
+    return datetime.fromtimestamp(secs, UTC)
+
+def _windows_to_datetime(val):
+    """Convert windows timestamp (100ns units since 1601) to UTC datetime"""
     # unix epoch (1970) in seconds from windows epoch (1601)
     unix_epoch = 11644473600
-    val1, pos = load_le32(buf, pos)
-    val2, pos = load_le32(buf, pos)
-    secs, n1secs = divmod((val2 << 32) | val1, 10000000)
+    secs, n1secs = divmod(val, 10000000)
     dt = datetime.fromtimestamp(secs - unix_epoch, UTC)
-    dt = dt.replace(microsecond=n1secs // 10)
-    return dt, pos
+    return dt.replace(microsecond=n1secs // 10)
 
 # new-style next volume
 def _next_newvol(volfile):
@@ -2682,22 +3227,20 @@ def _inc_volname(volfile, i):
         i -= 1
     return ''.join(fn)
 
-# rar3 extended time fields
-def _parse_ext_time(h, data, pos):
+# rar3 extended time fields, returns (mtime, ctime, atime, arctime)
+def _decode_ext_time(data, mtime):
     # flags and rest of data can be missing
     flags = 0
+    pos = 0
     if pos + 2 <= len(data):
         flags = S_SHORT.unpack_from(data, pos)[0]
         pos += 2
 
-    mtime, pos = _parse_xtime(flags >> 3 * 4, data, pos, h.mtime)
-    h.ctime, pos = _parse_xtime(flags >> 2 * 4, data, pos)
-    h.atime, pos = _parse_xtime(flags >> 1 * 4, data, pos)
-    h.arctime, pos = _parse_xtime(flags >> 0 * 4, data, pos)
-    if mtime:
-        h.mtime = mtime
-        h.date_time = mtime.timetuple()[:6]
-    return pos
+    mtime, pos = _parse_xtime(flags >> 3 * 4, data, pos, mtime)
+    ctime, pos = _parse_xtime(flags >> 2 * 4, data, pos)
+    atime, pos = _parse_xtime(flags >> 1 * 4, data, pos)
+    arctime, pos = _parse_xtime(flags >> 0 * 4, data, pos)
+    return mtime, ctime, atime, arctime
 
 # rar3 one extended time field
 def _parse_xtime(flag, data, pos, basetime=None):
@@ -2743,6 +3286,8 @@ def rar3_s2k(psw, salt):
     if not isinstance(psw, unicode):
         psw = psw.decode('utf8')
     seed = bytearray(psw.encode('utf-16le') + salt)
+    if len(seed) <= Rar3Sha1.block_size:
+        return _rar3_s2k_bulk(seed)
     h = Rar3Sha1(rarbug=True)
     iv = EMPTY
     for i in range(16):
@@ -2756,6 +3301,36 @@ def rar3_s2k(psw, salt):
     key_le = pack("<LLLL", *unpack(">LLLL", key_be))
     return key_le, iv
 
+def _rar3_s2k_bulk(seed):
+    """String-to-key for seeds that fit in one SHA1 block.
+
+    Rar3Sha1 only corrupts updates longer than a block, so the hash is
+    plain SHA1 and each round of 0x4000 (seed, counter) records can be
+    built in one buffer and hashed with a single update.
+    """
+    nrec = 0x4000
+    reclen = len(seed) + 3
+    buf = bytearray(reclen * nrec)
+    for i, b in enumerate(seed):
+        buf[i::reclen] = bytearray((b,)) * nrec
+    cpos = len(seed)
+    data = memoryview(buf)
+
+    h = sha1()
+    iv = EMPTY
+    for i in range(16):
+        # 3 low bytes of little-endian counter
+        cnt = pack('<%dL' % nrec, *range(i * nrec, (i + 1) * nrec))
+        buf[cpos::reclen] = cnt[0::4]
+        buf[cpos + 1::reclen] = cnt[1::4]
+        buf[cpos + 2::reclen] = cnt[2::4]
+        h.update(data[:reclen])
+        iv += h.digest()[19:20]
+        h.update(data[reclen:])
+    key_be = h.digest()[:16]
+    key_le = pack("<LLLL", *unpack(">LLLL", key_be))
+    return key_le, iv
+
 def rar3_decompress(vers, meth, data, declen=0, flags=0, crc=0, psw=None, salt=None):
     """Decompress blob of compressed data.
 
@@ -2790,17 +3365,25 @@ def rar3_decompress(vers, meth, data, declen=0, flags=0, crc=0, psw=None, salt=N
     # archive main header
     mh = S_BLK_HDR.pack(0x90CF, RAR_BLOCK_MAIN, 0, 13) + ZERO * (2 + 4)
 
+    archive = RAR_ID + mh + hdr + data
+    _ensure_unrar_tool()
+    cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
+    add_password_arg(cmd, psw, (flags & RAR_FILE_PASSWORD))
+
+    # give it to the tool on stdin if it can read it from there
+    if STDIN_ARCHIVE:
+        cmd.append(STDIN_ARCHIVE)
+        p = custom_popen(cmd)
+        return p.communicate(archive)[0]
+
     # decompress via temp rar
-    tmpfd, tmpname = mkstemp(suffix='.rar')
+    tmpfd, tmpname = rar_mkstemp(len(archive))
     tmpf = os.fdopen(tmpfd, "wb")
     try:
-        tmpf.write(RAR_ID + mh + hdr + data)
+        tmpf.write(archive)
         tmpf.close()
 
-        cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
-        add_password_arg(cmd, psw, (flags & RAR_FILE_PASSWORD))
         cmd.append(tmpname)
-
         p = custom_popen(cmd)
         return p.communicate()[0]
     finally:
@@ -2932,17 +3515,16 @@ def hmac_sha256(key, data):
 
 def membuf_tempfile(memfile):
     """Write in-memory file object to real file."""
+    size = memfile.seek(0, 2)
+    if size is None:
+        size = memfile.tell()
     memfile.seek(0, 0)
 
-    tmpfd, tmpname = mkstemp(suffix='.rar')
-    tmpf = os.fdopen(tmpfd, "wb")
+    tmpfd, tmpname = rar_mkstemp(size)
+    tmpf = os.fdopen(tmpfd, "wb", 0)
 
     try:
-        while True:
-            buf = memfile.read(BSIZE)
-            if not buf:
-                break
-            tmpf.write(buf)
+        copy_data(memfile, tmpf, size)
         tmpf.close()
     except:
         tmpf.close()
@@ -2950,6 +3532,67 @@ def membuf_tempfile(memfile):
         raise
     return tmpname
 
+def _temp_dir(size):
+    """Directory for a tmp archive of given size, see TEMP_DIR."""
+    if TEMP_DIR is not None:
+        return TEMP_DIR
+    shm = '/dev/shm'
+    try:
+        st = os.statvfs(shm)
+    except (AttributeError, OSError):
+        return None
+    # leave room for others
+    if st.f_bavail * st.f_frsize < 2 * size or not os.access(shm, os.W_OK):
+        return None
+    return shm
+
+def rar_mkstemp(size):
+    """Create tmp archive file for size bytes, returns (fd, name)."""
+    return mkstemp(suffix='.rar', dir=_temp_dir(size))
+
+def copy_data(src, dst, size):
+    """Copy size bytes from current position of src to dst.
+
+    Between real files and pipes the data is copied inside the kernel
+    (copy_file_range, then sendfile), otherwise in COPY_BLOCK_SIZE reads.
+    dst must be unbuffered.  Returns number of bytes copied.
+    """
+    done = 0
+    try:
+        infd = src.fileno()
+        outfd = dst.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        infd = outfd = None
+    if infd is not None:
+        pos = src.tell()
+        for name in ('copy_file_range', 'sendfile'):
+            func = getattr(os, name, None)
+            if func is None or done >= size:
+                continue
+            try:
+                while done < size:
+                    cnt = min(size - done, COPY_BLOCK_SIZE)
+                    if name == 'copy_file_range':
+                        res = func(infd, outfd, cnt, pos + done)
+                    else:
+                        res = func(outfd, infd, pos + done, cnt)
+                    if not res:
+                        break
+                    done += res
+            except OSError as ex:
+                # not supported for this pair, try next
+                if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                    errno.EBADF, errno.ENOTSOCK, errno.EPERM):
+                    raise
+        src.seek(pos + done)
+    while done < size:
+        buf = src.read(min(size - done, COPY_BLOCK_SIZE))
+        if not buf:
+            break
+        dst.write(buf)
+        done += len(buf)
+    return done
+
 class XTempFile(object):
     """Real file for archive.
     """
@@ -2979,12 +3622,14 @@ class XTempFile(object):
 #
 
 ORIG_UNRAR_TOOL = UNRAR_TOOL
+_unrar_tool_lock = Lock()
 ORIG_OPEN_ARGS = OPEN_ARGS
 ORIG_EXTRACT_ARGS = EXTRACT_ARGS
 ORIG_TEST_ARGS = TEST_ARGS
+ORIG_STDIN_ARCHIVE = STDIN_ARCHIVE
 
 def _check_unrar_tool():
-    global UNRAR_TOOL, OPEN_ARGS, EXTRACT_ARGS, TEST_ARGS
+    global UNRAR_TOOL, OPEN_ARGS, EXTRACT_ARGS, TEST_ARGS, STDIN_ARCHIVE
     try:
         # does UNRAR_TOOL work?
         custom_check([ORIG_UNRAR_TOOL], True)
@@ -2993,6 +3638,7 @@ def _check_unrar_tool():
         OPEN_ARGS = ORIG_OPEN_ARGS
         EXTRACT_ARGS = ORIG_EXTRACT_ARGS
         TEST_ARGS = ORIG_TEST_ARGS
+        STDIN_ARCHIVE = ORIG_STDIN_ARCHIVE
     except RarCannotExec:
         try:
             # does ALT_TOOL work?
@@ -3002,10 +3648,23 @@ def _check_unrar_tool():
             OPEN_ARGS = ALT_OPEN_ARGS
             EXTRACT_ARGS = ALT_EXTRACT_ARGS
             TEST_ARGS = ALT_TEST_ARGS
+            STDIN_ARCHIVE = ALT_STDIN_ARCHIVE
         except RarCannotExec:
             # no usable tool, only uncompressed archives work
             return False
     return True
 
-_check_unrar_tool()
+_unrar_tool_checked = False
+
+def _ensure_unrar_tool():
+    """Look for a working unrar tool (see _check_unrar_tool) the first time one is needed,
+    instead of at import, and remember the result for the rest of the process.
+    A UNRAR_TOOL set after import is used as it is."""
+    global _unrar_tool_checked
+    if not _unrar_tool_checked:
+        with _unrar_tool_lock:
+            if not _unrar_tool_checked:
+                if UNRAR_TOOL == ORIG_UNRAR_TOOL:
+                    _check_unrar_tool()
+                _unrar_tool_checked = True
 